@@ -0,0 +1,50 @@
+"""
+Decode time of a large API response (a synthetic artists/{id}/albums?limit=9999 payload with 3000 albums) for the
+old resp.json() path, json.loads(bytes) and the loads_json() used by TidalApi. Run from the repository root:
+
+    python benchmarks/bench_json.py
+"""
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'tests'))
+import conftest  # noqa: F401, loads the repository as the orpheus_tidal package
+
+from orpheus_tidal import tidal_api
+
+
+def payload(albums: int = 3000) -> bytes:
+    return json.dumps({
+        'limit': 9999, 'offset': 0, 'totalNumberOfItems': albums,
+        'items': [{
+            'id': 100000 + i, 'title': f'Album {i} (Deluxe Edition) éè', 'duration': 3600 + i,
+            'streamReady': True, 'streamStartDate': '2020-01-01T00:00:00.000+0000', 'allowStreaming': True,
+            'premiumStreamingOnly': False, 'numberOfTracks': 12, 'numberOfVideos': 0, 'numberOfVolumes': 1,
+            'releaseDate': '2020-01-01', 'copyright': '(P) 2020 Some Label', 'type': 'ALBUM', 'version': None,
+            'url': f'http://www.tidal.com/album/{100000 + i}', 'cover': 'a1b2c3d4-e5f6-7890-abcd-ef1234567890',
+            'videoCover': None, 'explicit': False, 'upc': f'{i:013d}', 'popularity': i % 100,
+            'audioQuality': 'LOSSLESS', 'audioModes': ['STEREO'],
+            'mediaMetadata': {'tags': ['LOSSLESS', 'HIRES_LOSSLESS']},
+            'artist': {'id': 1, 'name': 'Artist', 'type': 'MAIN', 'picture': None},
+            'artists': [{'id': 1, 'name': 'Artist', 'type': 'MAIN', 'picture': None}],
+        } for i in range(albums)]
+    }).encode()
+
+
+def bench(name: str, decode, content: bytes, number: int = 20):
+    seconds = min(timeit.repeat(lambda: decode(content), number=number, repeat=5)) / number
+    print(f'{name:<28} {seconds * 1000:7.2f} ms')
+
+
+if __name__ == '__main__':
+    content = payload()
+    print(f'payload: {len(content) / 1024 / 1024:.1f} MiB, orjson installed: {tidal_api.orjson is not None}')
+
+    # requests' resp.json() decodes the text and parses the str
+    bench('old resp.json()', lambda c: json.loads(c.decode('utf-8')), content)
+    bench('json.loads(bytes)', json.loads, content)
+    bench('loads_json()', tidal_api.loads_json, content)
+    if tidal_api.orjson is not None:
+        bench('orjson.loads(bytes)', tidal_api.orjson.loads, content)
@@ -0,0 +1,82 @@
+"""
+Time to turn the fragmented MP4 segments of a FLAC track into a .flac file, in-process with FlacDemuxer and with the
+ffmpeg subprocess (segments piped into stdin, -acodec copy) the module used before. The track is synthetic, 16 bit
+stereo 44.1 kHz with ~4 s segments like TIDAL's HI_RES_LOSSLESS/LOSSLESS DASH streams. Run from the repository root:
+
+    python benchmarks/bench_mp4.py [minutes]
+
+ffmpeg is taken from $FFMPEG or the PATH, its part is skipped if it isn't installed. With ffmpeg, both outputs are
+also decoded to PCM and compared
+"""
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'tests'))
+import conftest  # noqa: F401, loads the repository as the orpheus_tidal package
+
+from orpheus_tidal.tidal_mp4 import FlacDemuxer
+from test_mp4 import flac_stream
+
+
+def children_cpu() -> float:
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def run_demuxer(segments, path: str):
+    with open(path, 'w+b') as output:
+        demuxer = FlacDemuxer(output.write)
+        for segment in segments:
+            demuxer.feed(segment)
+        demuxer.close()
+        demuxer.patch_streaminfo(output)
+
+
+def run_ffmpeg(ffmpeg: str, segments, path: str):
+    process = subprocess.Popen([ffmpeg, '-hide_banner', '-loglevel', 'error', '-y', '-f', 'mp4', '-i', 'pipe:',
+                                '-acodec', 'copy', path], stdin=subprocess.PIPE)
+    for segment in segments:
+        process.stdin.write(segment)
+    process.stdin.close()
+    if process.wait() != 0:
+        raise RuntimeError(f'ffmpeg exited with {process.returncode}')
+
+
+def bench(name: str, run, repeat: int = 5):
+    wall, cpu = [], []
+    for _ in range(repeat):
+        start, start_cpu, start_children = time.perf_counter(), time.process_time(), children_cpu()
+        run()
+        wall.append(time.perf_counter() - start)
+        cpu.append(time.process_time() - start_cpu + children_cpu() - start_children)
+    print(f'{name:<12} {min(wall) * 1000:8.1f} ms wall {min(cpu) * 1000:8.1f} ms CPU')
+
+
+def decode(ffmpeg: str, path: str) -> bytes:
+    return subprocess.run([ffmpeg, '-loglevel', 'error', '-i', path, '-f', 's16le', '-'], check=True,
+                          capture_output=True).stdout
+
+
+if __name__ == '__main__':
+    minutes = float(sys.argv[1]) if len(sys.argv) > 1 else 4
+    # 43 frames of 4096 samples are ~4 s
+    segments, _ = flac_stream(max(1, round(minutes * 15)), frames=43, block_size=4096)
+    size = sum(map(len, segments))
+    print(f'{len(segments) - 1} segments, {size / 1024 / 1024:.1f} MiB')
+
+    with tempfile.TemporaryDirectory() as folder:
+        demuxed, converted = os.path.join(folder, 'demuxer.flac'), os.path.join(folder, 'ffmpeg.flac')
+        bench('FlacDemuxer', lambda: run_demuxer(segments, demuxed))
+
+        ffmpeg = os.environ.get('FFMPEG') or shutil.which('ffmpeg')
+        if ffmpeg is None:
+            print('ffmpeg           skipped, not installed')
+            sys.exit()
+
+        bench('ffmpeg', lambda: run_ffmpeg(ffmpeg, segments, converted))
+        print('same PCM:', decode(ffmpeg, demuxed) == decode(ffmpeg, converted))
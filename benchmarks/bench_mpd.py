@@ -0,0 +1,43 @@
+"""
+Parse time and retained memory of a 10k segment MPD for the old parser, which built a list with every segment url,
+and parse_mpd() with AudioTrack.iter_urls(). Run from the repository root:
+
+    python benchmarks/bench_mpd.py [segments]
+"""
+import os
+import sys
+import timeit
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'tests'))
+import conftest  # noqa: F401, loads the repository as the orpheus_tidal package
+
+from orpheus_tidal.tidal_mpd import parse_mpd
+from test_mpd import parse_mpd_list, timeline_mpd
+
+
+def retained(parse, xml: bytes) -> int:
+    # memory still allocated for the parse result after the XML tree is gone
+    tracemalloc.start()
+    result = parse(xml)
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del result
+    return size
+
+
+def bench(name: str, parse, xml: bytes):
+    seconds = min(timeit.repeat(lambda: parse(xml), number=1, repeat=5))
+    print(f'{name:<22} {seconds * 1000:7.1f} ms parse {retained(parse, xml) / 1024:8.0f} KiB retained')
+
+
+if __name__ == '__main__':
+    segments = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    for media in ('$Number$.mp4', '$Time$.mp4'):
+        xml = timeline_mpd(segments, media)
+        track, = parse_mpd(xml)
+        assert list(track.iter_urls()) == parse_mpd_list(xml)[0]
+
+        print(f'{media}, {len(track)} urls')
+        bench('url list', parse_mpd_list, xml)
+        bench('AudioTrack.iter_urls', parse_mpd, xml)
@@ -1,20 +1,33 @@
+import atexit
 import base64
 import json
 import logging
+import os
 import re
-import ffmpeg
+import threading
+import time
 
-from datetime import datetime
+from datetime import datetime, timedelta
 from getpass import getpass
 from dataclasses import dataclass
-from shutil import copyfileobj
-from xml.etree import ElementTree
-from tqdm import tqdm
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Optional
+from urllib.parse import urlparse, parse_qs
 
 from utils.models import *
-from utils.utils import sanitise_name, silentremove, download_to_temp, create_temp_filename, create_requests_session
-from .mqa_identifier_python.mqa_identifier_python.mqa_identifier import MqaIdentifier
-from .tidal_api import TidalTvSession, TidalApi, TidalMobileSession, SessionType, TidalError, TidalRequestError
+from utils.utils import sanitise_name, silentremove, create_temp_filename
+from .tidal_api import TidalTvSession, TidalApi, TidalMobileSession, TidalSession, LazySessions, SessionType, \
+    TidalError, TidalRequestError, TidalAuthError
+from .tidal_cache import SqliteResponseCache, LruCache, SqliteStore
+from .tidal_http import RequestScheduler, connection_pools
+from .tidal_download import SegmentDownloader, DownloadCheckpoint, download_url, download_ranges
+from .tidal_mp4 import FlacDemuxer, Mp4Error
+from .tidal_mpd import AudioTrack, MpdError, parse_mpd
+from .tidal_sync import SyncTracker, TrackState, PlaylistDiff, diff_playlist, album_watermark, iter_new_albums
+
+# ffmpeg, tqdm, ElementTree and MqaIdentifier are only imported where they are needed to keep the startup fast
+if TYPE_CHECKING:
+    from .mqa_identifier_python.mqa_identifier_python.mqa_identifier import MqaIdentifier
 
 module_information = ModuleInformation(
     service_name='TIDAL',
@@ -27,22 +40,64 @@ module_information = ModuleInformation(
         'mobile_hires_token': '6BDSRdpK9hqEBTgU',
         'enable_mobile': True,
         'prefer_ac4': False,
-        'fix_mqa': True
+        'fix_mqa': True,
+        'metadata_cache': True,
+        'metadata_cache_size': 256,
+        'api_concurrency': 8,
+        'requests_per_second': {'TV': 10, 'MOBILE_DEFAULT': 10, 'MOBILE_ATMOS': 10},
+        'max_retries': 5,
+        'album_cache_size': 256,
+        'metrics_file': '',
+        'subscription_check_ttl': 24,
+        'cdn_pool_size': 16,
+        'http2': False,
+        'dash_concurrency': 4,
+        'dash_global_concurrency': 16,
+        'segment_retries': 3,
+        'resumable_downloads': False,
+        'range_connections': 1,
+        'prefetch_manifests': False,
+        'manifest_cache_size': 1000,
+        'incremental_artist_sync': False,
+        'incremental_playlist_sync': False
     },
     # currently too broken to keep it, cover needs to be jpg else crash, problems on termux due to pillow
     # flags=ModuleFlags.needs_cover_resize,
-    session_storage_variables=['sessions'],
+    session_storage_variables=['sessions', 'subscriptions'],
     netlocation_constant='tidal',
     test_url='https://tidal.com/browse/track/92265335'
 )
 
 
+def signed_url_expiry(url: str) -> Optional[float]:
+    # unix time at which a signed CDN url expires, None if the url has no known expiry
+    query = parse_qs(urlparse(url).query)
+    for key in ('Expires', 'expires', 'exp'):
+        if query.get(key, [''])[0].isdigit():
+            return float(query[key][0])
+
+    # TIDAL (token=<expiry>~<signature>) and Akamai (hdnts=exp=<expiry>~acl=...) tokens
+    for key in ('token', 'hdnts', '__token__'):
+        for part in query.get(key, [''])[0].split('~'):
+            value = part[4:] if part.startswith('exp=') else part
+            if value.isdigit() and len(value) == 10:
+                return float(value)
+
+    return None
+
+
 @dataclass
-class AudioTrack:
+class StreamManifest:
+    stream_data: dict
+    # the decoded JSON manifest of single file streams or the MPD of MPEG-DASH streams
+    manifest: object
+    audio_track: Optional[AudioTrack]
     codec: CodecEnum
-    sample_rate: int
-    bitrate: int
-    urls: list
+    expires: float
+
+    def fresh(self, margin: int = 60) -> bool:
+        # the urls have to stay valid until the download started
+        return time.time() + margin < self.expires
 
 
 class ModuleInterface:
@@ -54,6 +109,10 @@ class ModuleInterface:
         self.disable_subscription_check = module_controller.orpheus_options.disable_subscription_check
         self.settings = module_controller.module_settings
 
+        # shared connection pools for api.tidal.com, auth.tidal.com and the audio CDN hosts
+        connection_pools.configure(api_pool_size=self.settings['api_concurrency'],
+                                   cdn_pool_size=self.settings['cdn_pool_size'], http2=self.settings['http2'])
+
         # LOW = 96kbit/s AAC, HIGH = 320kbit/s AAC, LOSSLESS = 44.1/16 FLAC, HI_RES <= 48/24 FLAC with MQA
         self.quality_parse = {
             QualityEnum.MINIMUM: 'LOW',
@@ -64,28 +123,18 @@ class ModuleInterface:
             QualityEnum.HIFI: 'HI_RES'
         }
 
-        # save all the TidalSession objects
-        sessions = {}
         self.available_sessions = [SessionType.TV.name, SessionType.MOBILE_DEFAULT.name, SessionType.MOBILE_ATMOS.name]
-
-        # load all saved sessions (TV, Mobile Atmos, Mobile Default)
-        saved_sessions = module_controller.temporary_settings_controller.read('sessions')
-        if not saved_sessions:
-            saved_sessions = {}
-
         if not self.settings['enable_mobile']:
             self.available_sessions = [SessionType.TV.name]
 
-        while True:
-            login_session = None
+        # saved sessions (TV, Mobile Atmos, Mobile Default) and subscription checks are stored in the temporary settings
+        self.temporary_settings = module_controller.temporary_settings_controller
+        self.temporary_settings_lock = threading.Lock()
+        # session used to create all missing sessions with its refresh token
+        self.login_session = None
 
-            def auth_and_save_session(session, session_type):
-                session = self.auth_session(session, session_type, login_session)
-
-                # get the dict representation from the TidalSession object and save it into saved_session/loginstorage
-                saved_sessions[session_type] = session.get_storage()
-                module_controller.temporary_settings_controller.set('sessions', saved_sessions)
-                return session
+        while True:
+            saved_sessions = self.temporary_settings.read('sessions')
 
             # ask for login if there are no saved sessions
             if not saved_sessions:
@@ -110,52 +159,85 @@ class ModuleInterface:
                         except KeyError:
                             self.print(f'{module_information.service_name}: Invalid choice, try again')
 
-                login_session = auth_and_save_session(self.init_session(login_session_type), login_session_type)
+                self.login_session = self.auth_session(self.init_session(login_session_type), login_session_type,
+                                                       None)
+                self.save_session(login_session_type, self.login_session)
+            else:
+                # load any saved session, no request needed as only the refresh token is used
+                login_session_type = next(iter(saved_sessions))
+                self.login_session = self.init_session(login_session_type)
+                self.login_session.set_storage(saved_sessions[login_session_type])
+
+            # only the TV session is needed on startup, the mobile sessions are loaded on first use
+            session, subscription = self.load_session(self.available_sessions[0])
+            if subscription:
+                break
 
-            for session_type in self.available_sessions:
-                sessions[session_type] = self.init_session(session_type)
+            confirm = input(' Do you want to relogin? [Y/n]: ')
 
-                if session_type in saved_sessions:
-                    logging.debug(f'{module_information.service_name}: {session_type} session found, loading')
+            if confirm.upper() == 'N':
+                self.print('Exiting...')
+                exit()
 
-                    # load the dictionary from the temporary_settings_controller inside the TidalSession class
-                    sessions[session_type].set_storage(saved_sessions[session_type])
-                else:
-                    logging.debug(
-                        f'{module_information.service_name}: No {session_type} session found, creating new one')
-                    sessions[session_type] = auth_and_save_session(sessions[session_type], session_type)
-
-                # always try to refresh session
-                if not sessions[session_type].valid():
-                    sessions[session_type].refresh()
-                    # Save the refreshed session in the temporary settings
-                    saved_sessions[session_type] = sessions[session_type].get_storage()
-                    module_controller.temporary_settings_controller.set('sessions', saved_sessions)
-
-                # check for a valid subscription
-                subscription = self.check_subscription(sessions[session_type].get_subscription())
-                if not subscription:
-                    confirm = input(' Do you want to relogin? [Y/n]: ')
-
-                    if confirm.upper() == 'N':
-                        self.print('Exiting...')
-                        exit()
-
-                    # reset saved sessions and loop back to login
-                    saved_sessions = {}
-                    break
+            # reset saved sessions and loop back to login
+            self.temporary_settings.set('sessions', {})
+            self.temporary_settings.set('subscriptions', {})
 
-                if not login_session:
-                    login_session = sessions[session_type]
+        # the validated startup session has the most recent refresh token
+        self.login_session = session
+        sessions = LazySessions(self.get_session)
+        sessions[self.available_sessions[0]] = session
 
-            if saved_sessions:
-                break
+        # limits the concurrent MPEG-DASH segment downloads across all tracks
+        self.segment_slots = threading.BoundedSemaphore(self.settings['dash_global_concurrency'])
+        # partly downloaded tracks which are resumed on the next run
+        self.checkpoint_folder = os.path.join(module_controller.data_folder, 'checkpoints')
 
-        # only needed for region locked albums where the track is available but force_album_format is used
-        self.album_cache = {}
+        # prefetched playback manifests of album tracks as futures, keyed by track id, quality and session type
+        self.manifest_cache = LruCache(self.settings['manifest_cache_size'])
+        self.manifest_executor = None
+        # album id, quality tier and codec options of the albums whose manifests were prefetched, bounded like the
+        # album cache
+        self.prefetched_albums = LruCache(self.settings['album_cache_size'])
+
+        # album data used by get_album_info and get_track_info, also holds the region locked album workarounds which
+        # are needed if the track is available but force_album_format is used
+        self.album_cache = LruCache(self.settings['album_cache_size'])
+
+        os.makedirs(module_controller.data_folder, exist_ok=True)
+        store_path = os.path.join(module_controller.data_folder, 'store.db')
+
+        # persistent metadata cache, playback info and stream urls are never cached
+        cache = None
+        if self.settings['metadata_cache']:
+            cache = SqliteResponseCache(os.path.join(module_controller.data_folder, 'cache.db'),
+                                        max_size=self.settings['metadata_cache_size'] * 1024 * 1024)
+            # the access times of cache hits are written in batches
+            atexit.register(cache.flush)
+
+        # rate limit every session type and retry throttled or failed requests
+        scheduler = RequestScheduler(self.settings['requests_per_second'], max_retries=self.settings['max_retries'])
 
         # load the Tidal session with all saved sessions (TV, Mobile Atmos, Mobile Default)
-        self.session: TidalApi = TidalApi(sessions)
+        self.session: TidalApi = TidalApi(sessions, cache=cache, max_workers=self.settings['api_concurrency'],
+                                          scheduler=scheduler, id_types=SqliteStore(store_path, 'id_types'))
+
+        # acknowledged and pending album ids and the newest album of every artist returned by get_artist_info
+        self.artist_sync = SqliteStore(store_path, 'artist_sync') if self.settings['incremental_artist_sync'] else None
+        # lastUpdated, numberOfTracks, the track ids and the pending track ids of every playlist returned by
+        # get_playlist_info
+        self.playlist_sync = SqliteStore(store_path, 'playlist_sync') \
+            if self.settings['incremental_playlist_sync'] else None
+        # returned albums and playlist tracks stay pending until they were handled, acknowledged after every album or
+        # playlist and at the end of the run. A track is handled once OrpheusDL moves on to the next item
+        self.sync_tracker = None
+        if self.artist_sync is not None or self.playlist_sync is not None:
+            self.sync_tracker = SyncTracker(self.artist_sync, self.playlist_sync)
+            atexit.register(self.sync_tracker.flush)
+
+        # write the per endpoint HTTP metrics at the end of the run, as JSON or in the Prometheus text format
+        if self.settings['metrics_file']:
+            atexit.register(self.session.metrics.dump, self.settings['metrics_file'])
 
     def init_session(self, session_type):
         session = None
@@ -190,6 +272,77 @@ class ModuleInterface:
 
         return session
 
+    def validate_session(self, session: TidalSession, cached_subscription: dict = None) -> (bool, dict):
+        # returns if the session got refreshed and its subscription check. Locally unexpired tokens are trusted and a
+        # cached subscription check of the same user is used if it's younger than subscription_check_ttl hours
+        refreshed = False
+        if not session.valid():
+            session.refresh()
+            refreshed = True
+
+        if cached_subscription and cached_subscription['user_id'] == session.user_id and \
+                datetime.now() - cached_subscription['checked'] < \
+                timedelta(hours=self.settings['subscription_check_ttl']):
+            return refreshed, cached_subscription
+
+        return refreshed, {
+            'user_id': session.user_id,
+            'subscription': session.get_subscription(),
+            'checked': datetime.now()
+        }
+
+    def save_session(self, session_type: str, session: TidalSession):
+        # get the dict representation from the TidalSession object and save it into loginstorage
+        with self.temporary_settings_lock:
+            saved_sessions = self.temporary_settings.read('sessions') or {}
+            saved_sessions[session_type] = session.get_storage()
+            self.temporary_settings.set('sessions', saved_sessions)
+
+    def load_session(self, session_type: str) -> (TidalSession, bool):
+        # loads the saved session or creates it from the login session, refreshes it if it's expired and returns the
+        # session with the result of its subscription check
+        session = self.init_session(session_type)
+
+        saved_sessions = self.temporary_settings.read('sessions') or {}
+        if session_type in saved_sessions:
+            logging.debug(f'{module_information.service_name}: {session_type} session found, loading')
+
+            # load the dictionary from the temporary_settings_controller inside the TidalSession class
+            session.set_storage(saved_sessions[session_type])
+        else:
+            logging.debug(f'{module_information.service_name}: No {session_type} session found, creating new one')
+            session = self.auth_session(session, session_type, self.login_session)
+            self.save_session(session_type, session)
+
+        subscriptions = self.temporary_settings.read('subscriptions') or {}
+        refreshed, subscription = self.validate_session(session, subscriptions.get(session_type))
+        if refreshed:
+            # Save the refreshed session in the temporary settings
+            self.save_session(session_type, session)
+
+        # check for a valid subscription
+        if not self.check_subscription(subscription['subscription']):
+            return session, False
+
+        # only cache valid subscriptions, so an invalid one is checked again on the next start
+        if subscription is not subscriptions.get(session_type):
+            with self.temporary_settings_lock:
+                subscriptions = self.temporary_settings.read('subscriptions') or {}
+                subscriptions[session_type] = subscription
+                self.temporary_settings.set('subscriptions', subscriptions)
+
+        return session, True
+
+    def get_session(self, session_type: str) -> TidalSession:
+        # called by LazySessions the first time a (mobile) session type is used
+        if session_type not in self.available_sessions:
+            raise KeyError(session_type)
+
+        session, subscription = self.load_session(session_type)
+        if not subscription:
+            raise TidalAuthError(f'{session_type} session does not have a valid subscription, please relogin')
+        return session
+
     def check_subscription(self, subscription: str) -> bool:
         # returns true if "disable_subscription_checks" is enabled or subscription is HIFI (Plus)
         if not self.disable_subscription_check and subscription not in {'HIFI', 'PREMIUM', 'PREMIUM_PLUS'}:
@@ -279,10 +432,22 @@ class ModuleInterface:
         return items
 
     def get_playlist_info(self, playlist_id: str) -> PlaylistInfo:
+        if self.sync_tracker is not None:
+            self.sync_tracker.advance()
+            self.sync_tracker.flush()
+
         playlist_data = self.session.get_playlist(playlist_id)
-        playlist_tracks = self.session.get_playlist_items(playlist_id)
 
-        tracks = [track.get('item').get('id') for track in playlist_tracks.get('items') if track.get('type') == 'track']
+        if self.playlist_sync is not None:
+            # only the tracks added since the last run and the ones which weren't handled yet are returned
+            diff = self.get_playlist_diff(playlist_id, playlist_data)
+            tracks, track_data = diff.added, diff.data
+            self.sync_tracker.watch_playlist(playlist_id, tracks)
+        else:
+            playlist_tracks = self.session.get_playlist_items(playlist_id)
+            tracks = [track.get('item').get('id') for track in playlist_tracks.get('items')
+                      if track.get('type') == 'track']
+            track_data = {track.get('item').get('id'): track.get('item') for track in playlist_tracks.get('items')}
 
         if 'name' in playlist_data.get('creator'):
             creator_name = playlist_data.get('creator').get('name')
@@ -309,40 +474,78 @@ class ModuleInterface:
             cover_url=cover_url,
             cover_type=cover_type,
             track_extra_kwargs={
-                'data': {track.get('item').get('id'): track.get('item') for track in playlist_tracks.get('items')}
+                'data': track_data
             }
         )
 
+    def get_playlist_diff(self, playlist_id: str, playlist_data: dict = None) -> PlaylistDiff:
+        # compares the playlist with its stored snapshot and stores the current one, needs incremental_playlist_sync.
+        # The added tracks stay pending in the snapshot until the SyncTracker acknowledges them
+        if playlist_data is None:
+            playlist_data = self.session.get_playlist(playlist_id)
+
+        snapshot = self.playlist_sync.get(playlist_id)
+        pending = snapshot.get('pending', []) if snapshot else []
+        if snapshot and snapshot['lastUpdated'] == playlist_data.get('lastUpdated') \
+                and snapshot['numberOfTracks'] == playlist_data.get('numberOfTracks'):
+            # unchanged, the items don't have to be fetched at all
+            return PlaylistDiff(added=pending, removed=[], moved=[], data={})
+
+        playlist_tracks = self.session.get_playlist_items(playlist_id)
+        items = [track.get('item') for track in playlist_tracks.get('items') if track.get('type') == 'track']
+        diff = diff_playlist(snapshot['tracks'] if snapshot else [], items, pending)
+
+        self.playlist_sync.set(playlist_id, {
+            'lastUpdated': playlist_data.get('lastUpdated'),
+            'numberOfTracks': playlist_data.get('numberOfTracks'),
+            'tracks': [item.get('id') for item in items],
+            'pending': diff.added
+        })
+        return diff
+
     def get_artist_info(self, artist_id: str, get_credited_albums: bool) -> ArtistInfo:
+        if self.sync_tracker is not None:
+            self.sync_tracker.advance()
+            self.sync_tracker.flush()
+
         artist_data = self.session.get_artist(artist_id)
 
-        artist_albums = self.session.get_artist_albums(artist_id).get('items')
-        artist_singles = self.session.get_artist_albums_ep_singles(artist_id).get('items')
+        # with incremental_artist_sync only the albums which weren't returned by a previous run are returned, and the
+        # pending ones of a previous run which weren't completely handled
+        sync = self.artist_sync.get(str(artist_id)) if self.artist_sync is not None else None
+        pending = set(sync.get('pending', [])) if sync else set()
+        known = set(sync['albums']) | pending if sync else None
+
+        if sync:
+            # only page until the already known albums are reached
+            artist_albums = list(iter_new_albums(
+                lambda offset, limit: self.session.get_artist_albums(artist_id, offset, limit), known,
+                sync['watermark']))
+            artist_singles = list(iter_new_albums(
+                lambda offset, limit: self.session.get_artist_albums_ep_singles(artist_id, offset, limit), known,
+                sync['watermark']))
+        else:
+            artist_albums = self.session.get_artist_albums(artist_id).get('items')
+            artist_singles = self.session.get_artist_albums_ep_singles(artist_id).get('items')
 
-        # Only works with a mobile session, annoying, never do this again
         credit_albums = []
         if get_credited_albums and SessionType.MOBILE_DEFAULT.name in self.available_sessions:
-            self.session.default = SessionType.MOBILE_DEFAULT
-            credited_albums_page = self.session.get_page('contributor', params={'artistId': artist_id})
-
-            # This is so retarded
-            page_list = credited_albums_page['rows'][-1]['modules'][0].get('pagedList')
-            if page_list:
-                total_items = page_list['totalNumberOfItems']
-                more_items_link = page_list['dataApiPath'][6:]
-
-                # Now fetch all the found total_items
-                items = []
-                for offset in range(0, total_items // 50 + 1):
-                    print(f'Fetching {offset * 50}/{total_items}', end='\r')
-                    items += self.session.get_page(more_items_link, params={'limit': 50, 'offset': offset * 50})[
-                        'items']
-
-                credit_albums = [item.get('item').get('album') for item in items]
-                self.session.default = SessionType.TV
+            credit_albums = list(self.iter_credited_albums(artist_id, known))
 
         # use set to filter out duplicate album ids
-        albums = {str(album.get('id')) for album in artist_albums + artist_singles + credit_albums}
+        albums = {str(album.get('id')) for album in artist_albums + artist_singles + credit_albums} | pending
+
+        if self.artist_sync is not None:
+            watermarks = [album_watermark(album) for album in artist_albums + artist_singles]
+            if sync and sync['watermark']:
+                watermarks.append(sync['watermark'])
+            # the returned albums are only acknowledged by the SyncTracker once all of their tracks were handled
+            self.artist_sync.set(str(artist_id), {
+                'albums': sync['albums'] if sync else [],
+                'pending': sorted(albums),
+                'watermark': max(watermarks) if watermarks else None
+            })
+            self.sync_tracker.watch_artist(artist_id, albums)
 
         return ArtistInfo(
             name=artist_data.get('name'),
@@ -350,40 +553,79 @@ class ModuleInterface:
             album_extra_kwargs={'data': {str(album.get('id')): album for album in artist_albums + artist_singles}}
         )
 
+    def iter_credited_albums(self, artist_id: str, known: set = None):
+        # Only works with a mobile session, annoying, never do this again
+        session = SessionType.MOBILE_DEFAULT
+        credited_albums_page = self.session.get_page('contributor', params={'artistId': artist_id},
+                                                     session_type=session)
+
+        # This is so retarded
+        page_list = credited_albums_page['rows'][-1]['modules'][0].get('pagedList')
+        if not page_list:
+            return
+
+        total_items = page_list['totalNumberOfItems']
+        more_items_link = page_list['dataApiPath'][6:]
+
+        if known is not None:
+            # newest credits first, fetch page by page until a page only has known albums
+            for offset in range(0, total_items, 50):
+                page = self.session.get_page(more_items_link, params={'limit': 50, 'offset': offset},
+                                             session_type=session)
+                albums = [item.get('item').get('album') for item in page['items']]
+                new_albums = [album for album in albums if str(album.get('id')) not in known]
+                yield from new_albums
+                if not new_albums:
+                    return
+                known = known | {str(album.get('id')) for album in new_albums}
+            return
+
+        # fetch all the found total_items concurrently and yield every album once, as soon as its page arrived
+        album_ids, fetched = set(), 0
+        for _, page in self.session.iter_paged_list(more_items_link, total_items, limit=50, session_type=session):
+            fetched += len(page['items'])
+            print(f'Fetching {fetched}/{total_items}', end='\r')
+
+            for item in page['items']:
+                album = item.get('item').get('album')
+                if str(album.get('id')) not in album_ids:
+                    album_ids.add(str(album.get('id')))
+                    yield album
+
     def get_album_info(self, album_id: str, data=None) -> AlbumInfo:
+        # acknowledge the previous track and album of an incremental artist sync
+        if self.sync_tracker is not None:
+            self.sync_tracker.advance()
+            self.sync_tracker.flush()
+
         # check if album is already in album cache, add it
         if data is None:
             data = {}
 
         if data.get(album_id):
             album_data = data[album_id]
-        elif self.album_cache.get(album_id):
-            album_data = self.album_cache[album_id]
+            self.album_cache.set(album_id, album_data)
         else:
-            album_data = self.session.get_album(album_id)
+            album_data = self._get_album(album_id)
 
-        # get all album tracks with corresponding credits with a limit of 100
-        limit = 100
+        # get all album tracks with corresponding credits, the pages after the first one are fetched concurrently
         cache = {'data': {}}
         try:
-            tracks_data = self.session.get_album_contributors(album_id, limit=limit)
-            total_tracks = tracks_data.get('totalNumberOfItems')
-
-            # round total_tracks to the next 100 and loop over the offset, that's hideous
-            for offset in range(limit, ((total_tracks // limit) + 1) * limit, limit):
-                # fetch the new album tracks with the given offset
-                track_items = self.session.get_album_contributors(album_id, offset=offset, limit=limit)
-                # append those tracks to the album_data
-                tracks_data['items'] += track_items.get('items')
-
-            # add the track contributors to a new list called 'credits'
-            cache = {'data': {}}
-            for track in tracks_data.get('items'):
-                track.get('item').update({'credits': track.get('credits')})
-                cache.get('data')[str(track.get('item').get('id'))] = track.get('item')
-
-            # filter out video clips
-            tracks = [str(track['item']['id']) for track in tracks_data.get('items') if track.get('type') == 'track']
+            pages = {}
+            for offset, page in self.session.iter_album_contributors(album_id):
+                # add the track contributors to the track data as 'credits'
+                for track in page.get('items'):
+                    track.get('item').update({'credits': track.get('credits')})
+                    cache.get('data')[str(track.get('item').get('id'))] = track.get('item')
+
+                # filter out video clips
+                pages[offset] = [str(track['item']['id']) for track in page.get('items')
+                                 if track.get('type') == 'track']
+
+            # put the tracks back in the album order
+            tracks = [track for offset in sorted(pages) for track in pages[offset]]
+            if self.sync_tracker is not None:
+                self.sync_tracker.set_album_tracks(album_id, tracks)
         except TidalError:
             tracks = []
 
@@ -432,31 +674,16 @@ class ModuleInterface:
             track_extra_kwargs=cache
         )
 
-    def get_track_info(self, track_id: str, quality_tier: QualityEnum, codec_options: CodecOptions,
-                       data=None) -> TrackInfo:
-        if data is None:
-            data = {}
-
-        track_data = data[track_id] if track_id in data else self.session.get_track(track_id)
-
-        album_id = str(track_data.get('album').get('id'))
-        # check if album is already in album cache, get it
-        try:
-            album_data = data[album_id] if album_id in data else self.session.get_album(album_id)
-        except TidalError as e:
-            # if an error occurs, catch it and set the album_data to an empty dict to catch it
-            self.print(f'{module_information.service_name}: {e} Trying workaround ...', drop_level=1)
-            album_data = track_data.get('album')
-            album_data.update({
-                'artist': track_data.get('artist'),
-                'numberOfVolumes': 1,
-                'audioQuality': 'LOSSLESS',
-                'audioModes': ['STEREO']
-            })
-
-            # add the region locked album to the cache in order to properly use it later (force_album_format)
-            self.album_cache = {album_id: album_data}
+    def _get_album(self, album_id: str) -> dict:
+        # returns the album from the album cache, fetches and caches it otherwise
+        album_data = self.album_cache.get(album_id)
+        if album_data is None:
+            album_data = self.session.get_album(album_id)
+            self.album_cache.set(album_id, album_data)
+        return album_data
 
+    def select_stream(self, track_data: dict, codec_options: CodecOptions, quality_tier: QualityEnum):
+        # returns the format and the session type used to get the stream of the track
         media_tags = track_data['mediaMetadata']['tags']
         format = None
         if codec_options.spatial_codecs:
@@ -485,60 +712,161 @@ class ModuleInterface:
             # so this shouldn't be an issue for now
             session = SessionType.MOBILE_DEFAULT
 
-        if session.name in self.available_sessions:
-            self.session.default = session
-        else:
+        # the session is passed per request, so tracks can be resolved concurrently with different sessions
+        if session.name not in self.available_sessions:
+            session = SessionType.TV
             format = None
 
+        return format, session
+
+    def resolve_stream(self, track_id: str, quality: str, session: SessionType) -> StreamManifest:
+        stream_data = self.session.get_stream_url(track_id, quality, session_type=session)
+
+        if stream_data['manifestMimeType'] == 'application/dash+xml':
+            manifest = base64.b64decode(stream_data['manifest'])
+            audio_track = parse_mpd(manifest, CodecEnum)[0]  # Only one AudioTrack?
+            codec, url = audio_track.codec, audio_track.initialization
+        else:
+            manifest = json.loads(base64.b64decode(stream_data['manifest']))
+            audio_track = None
+            codec = CodecEnum['AAC' if 'mp4a' in manifest['codecs'] else manifest['codecs'].upper()]
+            url = manifest['urls'][0]
+
+        # unsigned urls are assumed to be valid for a few minutes
+        expires = signed_url_expiry(url) or time.time() + 300
+        return StreamManifest(stream_data, manifest, audio_track, codec, expires)
+
+    def get_stream(self, track_id: str, quality: str, session: SessionType) -> StreamManifest:
+        # use the prefetched manifest unless its urls expired or the prefetch failed
+        future = self.manifest_cache.get((track_id, quality, session.name))
+        if future is not None:
+            try:
+                stream = future.result()
+                if stream.fresh():
+                    return stream
+            except Exception:
+                # any failure of the prefetch is retried once here, the error of this request is the one reported
+                pass
+
+        return self.resolve_stream(track_id, quality, session)
+
+    def prefetch_manifests(self, album_id: str, data: dict, quality_tier: QualityEnum, codec_options: CodecOptions):
+        # data holds the track data of all album tracks if the track is downloaded as part of an album, every album is
+        # only prefetched once per quality and codec options even if some of its manifests were evicted or failed
+        album_key = (album_id, quality_tier, codec_options.spatial_codecs, codec_options.proprietary_codecs)
+        if album_key in self.prefetched_albums:
+            return
+        self.prefetched_albums.set(album_key, True)
+
+        if self.manifest_executor is None:
+            self.manifest_executor = ThreadPoolExecutor(max_workers=self.settings['api_concurrency'])
+
+        # more tracks than the cache holds would evict the first prefetched manifests before they are used
+        tracks = [(track_id, track_data) for track_id, track_data in data.items() if isinstance(track_data, dict)
+                  and str((track_data.get('album') or {}).get('id')) == album_id]
+        for track_id, track_data in tracks[:self.manifest_cache.max_size]:
+            format, session = self.select_stream(track_data, codec_options, quality_tier)
+            quality = self.quality_parse[quality_tier] if format != 'flac_hires' else 'HI_RES_LOSSLESS'
+
+            key = (track_id, quality, session.name)
+            if key not in self.manifest_cache:
+                self.manifest_cache.set(key, self.manifest_executor.submit(
+                    self.resolve_stream, track_id, quality, session))
+
+    def get_track_info(self, track_id: str, quality_tier: QualityEnum, codec_options: CodecOptions,
+                       data=None) -> TrackInfo:
+        # OrpheusDL finished the previous track
+        if self.sync_tracker is not None:
+            self.sync_tracker.advance()
+
+        if data is None:
+            data = {}
+
+        track_data = data[track_id] if track_id in data else self.session.get_track(track_id)
+
+        album_id = str(track_data.get('album').get('id'))
+        # check if album is already in album cache, get it
+        try:
+            album_data = data[album_id] if album_id in data else self._get_album(album_id)
+        except TidalError as e:
+            # if an error occurs, catch it and set the album_data to an empty dict to catch it
+            self.print(f'{module_information.service_name}: {e} Trying workaround ...', drop_level=1)
+            album_data = track_data.get('album')
+            album_data.update({
+                'artist': track_data.get('artist'),
+                'numberOfVolumes': 1,
+                'audioQuality': 'LOSSLESS',
+                'audioModes': ['STEREO']
+            })
+
+            # add the region locked album to the cache in order to properly use it later (force_album_format)
+            self.album_cache.set(album_id, album_data)
+
+        format, session = self.select_stream(track_data, codec_options, quality_tier)
+        quality = self.quality_parse[quality_tier] if format != 'flac_hires' else 'HI_RES_LOSSLESS'
+
+        # resolve the playback manifests of all other album tracks in the background
+        if self.settings['prefetch_manifests']:
+            self.prefetch_manifests(album_id, data, quality_tier, codec_options)
+
         # define all default values in case the stream_data is None (region locked)
         audio_track, mqa_file, track_codec, bitrate, download_args, error = None, None, CodecEnum.FLAC, None, None, None
 
         try:
-            stream_data = self.session.get_stream_url(track_id, self.quality_parse[
-                quality_tier] if format != 'flac_hires' else 'HI_RES_LOSSLESS')
+            stream = self.get_stream(track_id, quality, session)
         except TidalRequestError as e:
             error = e
             # definitely region locked
             if 'Asset is not ready for playback' in str(e):
                 error = f'Track [{track_id}] is not available in your region'
-            stream_data = None
+            stream = None
+        except MpdError as e:
+            # e.g. a SegmentTemplate@duration without any duration to count the segments
+            error = f'Track [{track_id}] has an unsupported MPEG-DASH manifest: {e}'
+            stream = None
 
-        if stream_data is not None:
-            if stream_data['manifestMimeType'] == 'application/dash+xml':
-                manifest = base64.b64decode(stream_data['manifest'])
-                audio_track = self.parse_mpd(manifest)[0]  # Only one AudioTrack?
-                track_codec = audio_track.codec
-            else:
-                manifest = json.loads(base64.b64decode(stream_data['manifest']))
-                track_codec = CodecEnum['AAC' if 'mp4a' in manifest['codecs'] else manifest['codecs'].upper()]
+        stream_data = None
+        if stream is not None:
+            stream_data, manifest, audio_track, track_codec = \
+                stream.stream_data, stream.manifest, stream.audio_track, stream.codec
 
             if not codec_data[track_codec].spatial:
                 if not codec_options.proprietary_codecs and codec_data[track_codec].proprietary:
                     self.print(f'Proprietary codecs are disabled, if you want to download {track_codec.name}, '
                                f'set "proprietary_codecs": true', drop_level=1)
-                    stream_data = self.session.get_stream_url(track_id, 'LOSSLESS')
-
-                    if stream_data['manifestMimeType'] == 'application/dash+xml':
-                        manifest = base64.b64decode(stream_data['manifest'])
-                        audio_track = self.parse_mpd(manifest)[0]  # Only one AudioTrack?
-                        track_codec = audio_track.codec
-                    else:
-                        manifest = json.loads(base64.b64decode(stream_data['manifest']))
-                        track_codec = CodecEnum['AAC' if 'mp4a' in manifest['codecs'] else manifest['codecs'].upper()]
+                    stream = self.get_stream(track_id, 'LOSSLESS', session)
+                    stream_data, manifest, audio_track, track_codec = \
+                        stream.stream_data, stream.manifest, stream.audio_track, stream.codec
 
             if audio_track:
                 download_args = {'audio_track': audio_track}
             else:
+                # add the file to download_args
+                download_args = {'file_url': manifest['urls'][0]}
+
                 # check if MQA
                 if track_codec is CodecEnum.MQA and self.settings['fix_mqa']:
+                    from .mqa_identifier_python.mqa_identifier_python.mqa_identifier import MqaIdentifier
+
                     # download the first chunk of the flac file to analyze it
-                    temp_file_path = self.download_temp_header(manifest['urls'][0])
+                    header, size = self.download_header(manifest['urls'][0])
 
-                    # detect MQA file
-                    mqa_file = MqaIdentifier(temp_file_path)
+                    # detect MQA file, MqaIdentifier only reads from a path so the file is removed right after
+                    temp_file_path = create_temp_filename() + '.flac'
+                    try:
+                        with open(temp_file_path, 'wb') as f:
+                            f.write(header)
+                        mqa_file = MqaIdentifier(temp_file_path)
+                    finally:
+                        silentremove(temp_file_path)
 
-                # add the file to download_args
-                download_args = {'file_url': manifest['urls'][0]}
+                    # the download continues after the probed bytes
+                    if size:
+                        download_args.update(prefix=header, size=size)
+
+        # used to resume an interrupted download of the same track and quality
+        if download_args:
+            download_args.update(track_id=track_id, quality=stream_data['audioQuality'], codec=track_codec)
 
         # https://en.wikipedia.org/wiki/Audio_bit_depth#cite_ref-1
         bit_depth = (24 if stream_data and stream_data['audioQuality'] == 'HI_RES_LOSSLESS' else 16) \
@@ -609,136 +937,227 @@ class ModuleInterface:
 
         if error is not None:
             track_info.error = f'Error: {error}'
+        elif self.sync_tracker is not None:
+            # handled with the next item unless the download fails, existing tracks aren't downloaded again
+            self.sync_tracker.set_track_state(track_id, TrackState.STARTED)
 
         return track_info
 
     @staticmethod
-    def download_temp_header(file_url: str, chunk_size: int = 32768) -> str:
-        # create flac temp_location
-        temp_location = create_temp_filename() + '.flac'
-
-        # create session and download the file to the temp_location
-        r_session = create_requests_session()
-
-        r = r_session.get(file_url, stream=True, verify=False)
-        with open(temp_location, 'wb') as f:
-            # only download the first chunk_size bytes
+    def download_header(file_url: str, chunk_size: int = 32768) -> (bytes, int):
+        # only request the first chunk_size bytes using the shared CDN connection pool
+        with connection_pools.cdn.get(file_url, headers={'Range': f'bytes=0-{chunk_size - 1}'}, stream=True) as r:
+            r.raise_for_status()
+            header = b''
             for chunk in r.iter_content(chunk_size=chunk_size):
-                if chunk:  # filter out keep-alive new chunks
-                    f.write(chunk)
+                header += chunk
+                if len(header) >= chunk_size:
                     break
 
-        return temp_location
+        # the total size is only known if the server supports ranges, else the header can't be reused
+        size = int(r.headers['Content-Range'].split('/')[-1]) if r.status_code == 206 else None
+        return header[:chunk_size], size
 
-    @staticmethod
-    def parse_mpd(xml: bytes) -> list:
-        xml = xml.decode('UTF-8')
-        # Removes default namespace definition, don't do that!
-        xml = re.sub(r'xmlns="[^"]+"', '', xml, count=1)
-        root = ElementTree.fromstring(xml)
-
-        # List of AudioTracks
-        tracks = []
-
-        for period in root.findall('Period'):
-            for adaptation_set in period.findall('AdaptationSet'):
-                for rep in adaptation_set.findall('Representation'):
-                    # Check if representation is audio
-                    content_type = adaptation_set.get('contentType')
-                    if content_type != 'audio':
-                        raise ValueError('Only supports audio MPDs!')
-
-                    # Codec checks
-                    codec = rep.get('codecs').upper()
-                    if codec.startswith('MP4A'):
-                        codec = 'AAC'
-
-                    # Segment template
-                    seg_template = rep.find('SegmentTemplate')
-                    # Add init file to track_urls
-                    track_urls = [seg_template.get('initialization')]
-                    start_number = int(seg_template.get('startNumber') or 1)
-
-                    # https://dashif-documents.azurewebsites.net/Guidelines-TimingModel/master/Guidelines-TimingModel.html#addressing-explicit
-                    # Also see example 9
-                    seg_timeline = seg_template.find('SegmentTimeline')
-                    if seg_timeline is not None:
-                        seg_time_list = []
-                        cur_time = 0
-
-                        for s in seg_timeline.findall('S'):
-                            # Media segments start time
-                            if s.get('t'):
-                                cur_time = int(s.get('t'))
-
-                            # Segment reference
-                            for i in range((int(s.get('r') or 0) + 1)):
-                                seg_time_list.append(cur_time)
-                                # Add duration to current time
-                                cur_time += int(s.get('d'))
-
-                        # Create list with $Number$ indices
-                        seg_num_list = list(range(start_number, len(seg_time_list) + start_number))
-                        # Replace $Number$ with all the seg_num_list indices
-                        track_urls += [seg_template.get('media').replace('$Number$', str(n)) for n in seg_num_list]
-
-                    tracks.append(AudioTrack(
-                        codec=CodecEnum[codec],
-                        sample_rate=int(rep.get('audioSamplingRate') or 0),
-                        bitrate=int(rep.get('bandwidth') or 0),
-                        urls=track_urls
-                    ))
-
-        return tracks
-
-    def get_track_download(self, file_url: str = None, audio_track: AudioTrack = None) \
-            -> TrackDownloadInfo:
-        # only file_url or audio_track at a time
-
-        # MHA1, EC-3 or MQA
-        if file_url:
-            return TrackDownloadInfo(download_type=DownloadEnum.URL, file_url=file_url)
+    def download_segments(self, audio_track: AudioTrack, write, start: int = 0):
+        from tqdm import tqdm
 
-        # MPEG-DASH
         # use the total_file size for a better progress bar? Is it even possible to calculate the total size from MPD?
+        # one progress bar for all download workers, updated for every finished segment
         try:
             columns = os.get_terminal_size().columns
             if os.name == 'nt':
-                bar = tqdm(audio_track.urls, ncols=(columns - self.oprinter.indent_number),
+                bar = tqdm(total=len(audio_track), initial=start, ncols=(columns - self.oprinter.indent_number),
                            bar_format=' ' * self.oprinter.indent_number + '{l_bar}{bar}{r_bar}')
             else:
                 raise OSError
         except OSError:
-            bar = tqdm(audio_track.urls, bar_format=' ' * self.oprinter.indent_number + '{l_bar}{bar}{r_bar}')
+            bar = tqdm(total=len(audio_track), initial=start,
+                       bar_format=' ' * self.oprinter.indent_number + '{l_bar}{bar}{r_bar}')
+
+        # download the segments concurrently and pass them in order to write()
+        downloader = SegmentDownloader(connection_pools.cdn, concurrency=self.settings['dash_concurrency'],
+                                       global_slots=self.segment_slots, progress=bar,
+                                       max_retries=self.settings['segment_retries'])
+        # skip the segments which are already downloaded
+        segments = downloader.iter_segments(audio_track.iter_urls(start))
+        try:
+            for segment in segments:
+                write(segment)
+        finally:
+            segments.close()
+            # needed for bar indent
+            bar.close()
+
+    def get_track_download(self, track_id: str = None, **kwargs) -> TrackDownloadInfo:
+        if self.sync_tracker is None or not track_id:
+            return self.download_track(track_id=track_id, **kwargs)
+
+        # incremental syncs only acknowledge the track if the download didn't fail or get interrupted, a returned URL is
+        # still downloaded by OrpheusDL
+        self.sync_tracker.set_track_state(track_id, TrackState.DOWNLOADING)
+        try:
+            download_info = self.download_track(track_id=track_id, **kwargs)
+        except BaseException:
+            self.sync_tracker.set_track_state(track_id, TrackState.FAILED)
+            raise
+        self.sync_tracker.set_track_state(track_id, TrackState.STARTED)
+        return download_info
+
+    def download_track(self, file_url: str = None, audio_track: AudioTrack = None, track_id: str = None,
+                       quality: str = None, codec: CodecEnum = None, prefix: bytes = None,
+                       size: int = None) -> TrackDownloadInfo:
+        # only file_url or audio_track at a time
 
-        # download all segments and save the locations inside temp_locations
-        temp_locations = []
-        for download_url in bar:
-            temp_locations.append(download_to_temp(download_url, extension='mp4'))
+        checkpoint = None
+        if self.settings['resumable_downloads'] and track_id:
+            checkpoint = DownloadCheckpoint(self.checkpoint_folder, f'{track_id}_{quality}_{codec.name}')
 
-        # needed for bar indent
-        bar.close()
+        # MHA1, EC-3 or MQA
+        if file_url:
+            # the first bytes of MQA files are already downloaded by the MQA probe
+            if checkpoint is None and (self.settings['range_connections'] > 1 or prefix):
+                # split the file into byte ranges which are downloaded over several pooled connections
+                temp_location = create_temp_filename() + '.' + codec_data[codec].container.name
+                try:
+                    download_ranges(connection_pools.cdn, file_url, temp_location,
+                                    connections=self.settings['range_connections'],
+                                    max_retries=self.settings['segment_retries'], prefix=prefix or b'', size=size)
+                except BaseException:
+                    silentremove(temp_location)
+                    raise
+
+                return TrackDownloadInfo(download_type=DownloadEnum.TEMP_FILE_PATH, temp_file_path=temp_location)
+
+            if checkpoint is None:
+                return TrackDownloadInfo(download_type=DownloadEnum.URL, file_url=file_url)
+
+            # resumed with a Range request from the last checkpointed byte
+            try:
+                if prefix and not checkpoint.size:
+                    checkpoint.set_total(size)
+                    checkpoint.append(prefix)
+                download_url(connection_pools.cdn, file_url, checkpoint, max_retries=self.settings['segment_retries'])
+            finally:
+                checkpoint.close()
 
-        # concatenated/Merged .mp4 file
-        merged_temp_location = create_temp_filename() + '.mp4'
+            return TrackDownloadInfo(
+                download_type=DownloadEnum.TEMP_FILE_PATH,
+                temp_file_path=checkpoint.finish(create_temp_filename() + '.' + codec_data[codec].container.name)
+            )
+
+        # MPEG-DASH
         # actual converted .flac file
         output_location = create_temp_filename() + '.' + codec_data[audio_track.codec].container.name
 
-        # download is finished, merge chunks into 1 file
+        if checkpoint is not None:
+            return self.download_resumable_segments(audio_track, checkpoint, output_location)
+
+        # FLAC frames are extracted from the segments in-process, ffmpeg is only needed for the other codecs
+        if audio_track.codec is CodecEnum.FLAC and self.demux_flac(
+                output_location, lambda write: self.download_segments(audio_track, write)):
+            return TrackDownloadInfo(
+                download_type=DownloadEnum.TEMP_FILE_PATH,
+                temp_file_path=output_location,
+            )
+
+        # pipe the segments in order into ffmpeg's stdin, so only the converted file is written to disk
+        try:
+            import ffmpeg
+            process = ffmpeg.input('pipe:', f='mp4', hide_banner=None, y=None).output(
+                output_location, acodec='copy', loglevel='error').run_async(pipe_stdin=True)
+        except (ImportError, OSError):
+            process = None
+
+        if process is not None:
+            try:
+                self.download_segments(audio_track, process.stdin.write)
+                process.stdin.close()
+            except BrokenPipeError:
+                # ffmpeg exited early, checked with its return code below
+                pass
+            except BaseException:
+                process.kill()
+                process.wait()
+                silentremove(output_location)
+                raise
+
+            if process.wait() == 0:
+                # return the converted flac file now
+                return TrackDownloadInfo(
+                    download_type=DownloadEnum.TEMP_FILE_PATH,
+                    temp_file_path=output_location,
+                )
+
+            silentremove(output_location)
+
+        self.print('FFmpeg is not installed or working! Using fallback, may have errors')
+
+        # concatenated/Merged .mp4 file, written once
+        merged_temp_location = create_temp_filename() + '.mp4'
         with open(merged_temp_location, 'wb') as dest_file:
-            for temp_location in temp_locations:
-                with open(temp_location, 'rb') as segment_file:
-                    copyfileobj(segment_file, dest_file)
+            self.download_segments(audio_track, dest_file.write)
+
+        # return the MP4 temp file, but tell orpheus to change the container to .m4a (AAC)
+        return TrackDownloadInfo(
+            download_type=DownloadEnum.TEMP_FILE_PATH,
+            temp_file_path=merged_temp_location,
+            different_codec=CodecEnum.AAC
+        )
 
-        # convert .mp4 back to .flac
+    @staticmethod
+    def demux_flac(output_location: str, read) -> bool:
+        # read(write) passes the fragmented MP4 data to write(), returns False if the MP4 layout isn't supported
         try:
-            ffmpeg.input(merged_temp_location, hide_banner=None, y=None).output(output_location, acodec='copy',
-                                                                                loglevel='error').run()
-            # Remove all files
+            with open(output_location, 'w+b') as output:
+                demuxer = FlacDemuxer(output.write)
+                read(demuxer.feed)
+                demuxer.close()
+                demuxer.patch_streaminfo(output)
+            return True
+        except Mp4Error as e:
+            silentremove(output_location)
+            logging.debug(f'{module_information.service_name}: Could not demux FLAC, using FFmpeg: {e}')
+            return False
+        except BaseException:
+            silentremove(output_location)
+            raise
+
+    def download_resumable_segments(self, audio_track: AudioTrack, checkpoint: DownloadCheckpoint,
+                                    output_location: str) -> TrackDownloadInfo:
+        # the segments are appended to the checkpoint, so only the missing segments are downloaded after a restart
+        try:
+            self.download_segments(audio_track, checkpoint.append, start=checkpoint.completed)
+        finally:
+            checkpoint.close()
+
+        # concatenated/Merged .mp4 file
+        merged_temp_location = checkpoint.finish(create_temp_filename() + '.mp4')
+
+        def read_merged(write):
+            with open(merged_temp_location, 'rb') as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                    write(chunk)
+
+        if audio_track.codec is CodecEnum.FLAC and self.demux_flac(output_location, read_merged):
+            silentremove(merged_temp_location)
+            return TrackDownloadInfo(
+                download_type=DownloadEnum.TEMP_FILE_PATH,
+                temp_file_path=output_location,
+            )
+
+        try:
+            import ffmpeg
+            ffmpeg.input(merged_temp_location, hide_banner=None, y=None).output(
+                output_location, acodec='copy', loglevel='error').run()
             silentremove(merged_temp_location)
-            for temp_location in temp_locations:
-                silentremove(temp_location)
-        except:
+
+            # return the converted flac file now
+            return TrackDownloadInfo(
+                download_type=DownloadEnum.TEMP_FILE_PATH,
+                temp_file_path=output_location,
+            )
+        except Exception:
+            silentremove(output_location)
             self.print('FFmpeg is not installed or working! Using fallback, may have errors')
 
             # return the MP4 temp file, but tell orpheus to change the container to .m4a (AAC)
@@ -748,12 +1167,6 @@ class ModuleInterface:
                 different_codec=CodecEnum.AAC
             )
 
-        # return the converted flac file now
-        return TrackDownloadInfo(
-            download_type=DownloadEnum.TEMP_FILE_PATH,
-            temp_file_path=output_location,
-        )
-
     def get_track_cover(self, track_id: str, cover_options: CoverOptions, data=None) -> CoverInfo:
         if data is None:
             data = {}
@@ -829,7 +1242,7 @@ class ModuleInterface:
         return None
 
     @staticmethod
-    def convert_tags(track_data: dict, album_data: dict, mqa_file: MqaIdentifier = None) -> Tags:
+    def convert_tags(track_data: dict, album_data: dict, mqa_file: 'MqaIdentifier' = None) -> Tags:
         track_name = track_data.get('title')
         track_name += f' ({track_data.get("version")})' if track_data.get('version') else ''
 
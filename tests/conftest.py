@@ -0,0 +1,14 @@
+import importlib.util
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# the module uses relative imports, load the repository as the orpheus_tidal package. interface.py needs OrpheusDL's
+# utils package and isn't imported by the tests
+if 'orpheus_tidal' not in sys.modules:
+    spec = importlib.util.spec_from_file_location('orpheus_tidal', os.path.join(ROOT, '__init__.py'),
+                                                  submodule_search_locations=[ROOT])
+    package = importlib.util.module_from_spec(spec)
+    sys.modules['orpheus_tidal'] = package
+    spec.loader.exec_module(package)
@@ -0,0 +1,117 @@
+import asyncio
+import json
+
+import pytest
+
+from orpheus_tidal.tidal_api import TidalError, SessionType
+from orpheus_tidal.tidal_async import AsyncTidalApi
+
+
+class FakeSession:
+    country_code = 'US'
+
+    def __init__(self):
+        self.token = 'old'
+
+    def auth_headers(self):
+        return {'Authorization': 'Bearer ' + self.token}
+
+    def refresh(self):
+        self.token = 'new'
+
+
+NOT_FOUND = {'status': 404, 'subStatus': 2001, 'userMessage': 'Not found'}
+
+
+class FakeAsyncTidalApi(AsyncTidalApi):
+    """
+    AsyncTidalApi which answers requests with routes[url](params, headers) instead of sending them
+    """
+    def __init__(self, routes):
+        super().__init__({session_type.name: FakeSession() for session_type in SessionType})
+        self.routes = routes
+        self.requests = []
+
+    async def _send(self, session_type, url, headers, params):
+        self.requests.append(url)
+        status_code, body = await self.routes[url](params, headers)
+        return status_code, {}, json.dumps(body).encode()
+
+
+def respond(body, status_code=200, delay=0.0):
+    async def route(params, headers):
+        await asyncio.sleep(delay)
+        return status_code, body
+    return route
+
+
+def test_get_refreshes_the_token_after_401():
+    async def route(params, headers):
+        return (200, {'id': 1}) if headers['Authorization'] == 'Bearer new' else (401, {})
+
+    api = FakeAsyncTidalApi({'albums/1': route})
+    assert asyncio.run(api.get_album(1)) == {'id': 1}
+    assert api.requests == ['albums/1', 'albums/1']
+
+
+def test_iter_paged_list_awaits_every_page():
+    async def route(params, headers):
+        return 200, {'items': [params['offset']]}
+
+    async def crawl(api):
+        return [(offset, page) async for offset, page in api.iter_paged_list('contributor/items', 120)]
+
+    api = FakeAsyncTidalApi({'pages/contributor/items': route})
+    pages = asyncio.run(crawl(api))
+
+    assert sorted(pages) == [(0, {'items': [0]}), (50, {'items': [50]}), (100, {'items': [100]})]
+
+
+def test_iter_album_contributors_fetches_all_pages():
+    async def route(params, headers):
+        return 200, {'totalNumberOfItems': 250, 'items': [params['offset']]}
+
+    async def crawl(api):
+        return sorted([offset async for offset, _ in api.iter_album_contributors('1')])
+
+    api = FakeAsyncTidalApi({'albums/1/items/credits': route})
+    assert asyncio.run(crawl(api)) == [0, 100, 200]
+
+
+def test_thread_pagination_is_refused():
+    api = FakeAsyncTidalApi({})
+    with pytest.raises(TidalError):
+        api._iter_pages(None, [0])
+
+
+def test_get_type_from_id_returns_first_success_and_cancels_the_rest():
+    cancelled = []
+
+    async def slow(params, headers):
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.append(True)
+            raise
+        return 200, {'id': 1}
+
+    api = FakeAsyncTidalApi({
+        'albums/1': respond(NOT_FOUND, 404),
+        'artists/1': respond({'id': 1}, delay=0.01),
+        'tracks/1': slow,
+        'videos/1': slow,
+    })
+
+    assert asyncio.run(asyncio.wait_for(api.get_type_from_id(1), 1)) == 'r'
+    assert cancelled == [True, True]
+
+
+def test_get_type_from_id_keeps_the_priority():
+    api = FakeAsyncTidalApi({
+        'albums/1': respond({'id': 1}, delay=0.02),
+        'artists/1': respond({'id': 1}),
+        'tracks/1': respond({'id': 1}),
+        'videos/1': respond(NOT_FOUND, 404),
+    })
+
+    assert asyncio.run(api.get_type_from_id(1)) == 'a'
@@ -0,0 +1,72 @@
+import os
+
+from orpheus_tidal.tidal_cache import LruCache, SqliteResponseCache, SqliteStore
+
+
+def test_lru_cache_evicts_least_recently_used():
+    cache = LruCache(2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.get('a')
+    cache.set('c', 3)
+
+    assert 'a' in cache and 'c' in cache and 'b' not in cache
+
+
+def test_response_cache_round_trip(tmp_path):
+    cache = SqliteResponseCache(str(tmp_path / 'cache.db'))
+    cache.set('key', b'{"id": 1}', etag='"abc"', ttl=60)
+
+    entry = cache.get('key')
+    assert entry.content == b'{"id": 1}'
+    assert entry.fresh()
+    assert entry.validators() == {'If-None-Match': '"abc"'}
+    assert cache.get('missing') is None
+
+
+def test_response_cache_keeps_a_running_total(tmp_path):
+    path = str(tmp_path / 'cache.db')
+    cache = SqliteResponseCache(path)
+    cache.set('a', b'a' * 1000)
+    cache.set('b', b'b' * 1000)
+    cache.set('a', b'a' * 2000)
+
+    stored = cache.db.execute('SELECT SUM(size) FROM responses').fetchone()[0]
+    assert cache.total_size == stored
+    # the total is read again from the database after a restart
+    assert SqliteResponseCache(path).total_size == stored
+
+
+def test_response_cache_hits_are_not_written_immediately(tmp_path):
+    cache = SqliteResponseCache(str(tmp_path / 'cache.db'), flush_size=3)
+    for key in 'abc':
+        cache.set(key, key.encode())
+
+    cache.get('a')
+    assert list(cache.accessed) == ['a']
+    cache.get('b')
+    cache.get('c')
+    # the third hit reached flush_size and wrote all access times at once
+    assert cache.accessed == {}
+
+
+def test_response_cache_evicts_least_recently_used(tmp_path):
+    cache = SqliteResponseCache(str(tmp_path / 'cache.db'), max_size=1000)
+    cache.set('old', os.urandom(400))
+    cache.set('new', os.urandom(400))
+    # the pending access time of the cache hit is used for the eviction order
+    cache.get('old')
+    cache.set('newest', os.urandom(400))
+
+    assert cache.get('old') is not None
+    assert cache.get('new') is None
+    assert cache.total_size <= cache.max_size
+
+
+def test_store_round_trip(tmp_path):
+    store = SqliteStore(str(tmp_path / 'store.db'), 'test')
+    store.set('key', {'a': [1, 2]})
+
+    assert store.get('key') == {'a': [1, 2]}
+    store.delete('key')
+    assert store.get('key', 'default') == 'default'
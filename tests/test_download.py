@@ -0,0 +1,201 @@
+import threading
+
+import pytest
+
+from orpheus_tidal import tidal_download
+from orpheus_tidal.tidal_download import DownloadCheckpoint, download_url, download_ranges
+
+
+class FakeResponse:
+    def __init__(self, status_code=200, headers=None, body=b''):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.body = body
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise OSError(f'HTTP {self.status_code}')
+
+    def iter_content(self, chunk_size=1):
+        for i in range(0, len(self.body), chunk_size):
+            yield self.body[i:i + chunk_size]
+
+
+class FakeFileSession:
+    # serves data with Range support like the TIDAL CDN, a Range from the end of the file is unsatisfiable
+    def __init__(self, data: bytes, ranges: bool = True):
+        self.data = data
+        self.ranges = ranges
+        self.requests = []
+        self.lock = threading.Lock()
+
+    def get(self, url, headers=None, stream=False):
+        headers = headers or {}
+        with self.lock:
+            self.requests.append(headers.get('Range'))
+        if 'Range' not in headers or not self.ranges:
+            return FakeResponse(200, {'Content-Length': str(len(self.data))}, self.data)
+
+        start, end = headers['Range'][len('bytes='):].split('-')
+        start, end = int(start), min(int(end or len(self.data) - 1), len(self.data) - 1)
+        if start >= len(self.data):
+            return FakeResponse(416, {'Content-Range': f'bytes */{len(self.data)}'})
+        return FakeResponse(206, {'Content-Range': f'bytes {start}-{end}/{len(self.data)}'}, self.data[start:end + 1])
+
+
+class NoProbeSession(FakeFileSession):
+    # a CDN which rejects the one byte probe, but serves the whole file
+    def get(self, url, headers=None, stream=False):
+        if headers and headers.get('Range') == 'bytes=0-0':
+            return FakeResponse(405)
+        return super(NoProbeSession, self).get(url, headers, stream)
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(tidal_download, '_backoff', lambda attempt: None)
+
+
+def test_download_url(tmp_path):
+    session = FakeFileSession(bytes(range(256)) * 10)
+    checkpoint = DownloadCheckpoint(str(tmp_path), 'track')
+    download_url(session, 'url', checkpoint, chunk_size=1000)
+
+    assert session.requests == [None]
+    assert checkpoint.sizes == [1000, 1000, 560]
+    assert open(checkpoint.finish(str(tmp_path / 'track.flac')), 'rb').read() == session.data
+
+
+def test_download_url_resumes(tmp_path):
+    session = FakeFileSession(bytes(range(256)) * 10)
+    checkpoint = DownloadCheckpoint(str(tmp_path), 'track')
+    checkpoint.set_total(len(session.data))
+    checkpoint.append(session.data[:1000])
+    checkpoint.close()
+
+    checkpoint = DownloadCheckpoint(str(tmp_path), 'track')
+    download_url(session, 'url', checkpoint)
+    assert session.requests == ['bytes=1000-']
+    assert open(checkpoint.finish(str(tmp_path / 'track.flac')), 'rb').read() == session.data
+
+
+def test_download_url_complete_checkpoint(tmp_path):
+    # a restart after the last chunk but before finish() must not request the range after the end of the file
+    session = FakeFileSession(b'flac' * 100)
+    checkpoint = DownloadCheckpoint(str(tmp_path), 'track')
+    checkpoint.set_total(len(session.data))
+    checkpoint.append(session.data)
+    checkpoint.close()
+
+    checkpoint = DownloadCheckpoint(str(tmp_path), 'track')
+    download_url(session, 'url', checkpoint)
+    assert session.requests == []
+    assert checkpoint.size == len(session.data)
+
+
+def test_download_url_unsatisfiable_range_restarts(tmp_path):
+    # the checkpoint has more data than the file on the server, e.g. from an older manifest without a total
+    session = FakeFileSession(b'flac' * 100)
+    checkpoint = DownloadCheckpoint(str(tmp_path), 'track')
+    checkpoint.append(b'x' * 500)
+
+    download_url(session, 'url', checkpoint, max_retries=0)
+    assert session.requests == ['bytes=500-', None]
+    assert open(checkpoint.finish(str(tmp_path / 'track.flac')), 'rb').read() == session.data
+
+
+class ChangingFileSession(FakeFileSession):
+    # the connection drops after the first 400 bytes, the retry is served by an edge with a newer version of the file
+    def __init__(self, data: bytes, new_data: bytes):
+        super(ChangingFileSession, self).__init__(data)
+        self.new_data = new_data
+
+    def get(self, url, headers=None, stream=False):
+        r = super(ChangingFileSession, self).get(url, headers, stream)
+        if len(self.requests) == 1:
+            r.iter_content = self.broken_content(self.data)
+            self.data = self.new_data
+        return r
+
+    @staticmethod
+    def broken_content(data: bytes):
+        def iter_content(chunk_size=1):
+            yield data[:400]
+            raise OSError('Connection reset by peer')
+        return iter_content
+
+
+def test_download_url_total_changed(tmp_path):
+    session = ChangingFileSession(b'a' * 1000, bytes(range(256)) * 5)
+    checkpoint = DownloadCheckpoint(str(tmp_path), 'track')
+    download_url(session, 'url', checkpoint, chunk_size=100)
+
+    # the 206 response for the old offset is discarded, the new file is downloaded from the start
+    assert session.requests == [None, 'bytes=400-', None]
+    assert open(checkpoint.finish(str(tmp_path / 'track.flac')), 'rb').read() == session.new_data
+
+
+def test_download_url_gives_up(tmp_path):
+    class BrokenSession:
+        def get(self, url, headers=None, stream=False):
+            return FakeResponse(503)
+
+    checkpoint = DownloadCheckpoint(str(tmp_path), 'track')
+    with pytest.raises(OSError):
+        download_url(BrokenSession(), 'url', checkpoint, max_retries=2)
+    checkpoint.close()
+
+
+def test_download_ranges(tmp_path):
+    session = FakeFileSession(bytes(range(256)) * 40)
+    path = str(tmp_path / 'track.flac')
+    download_ranges(session, 'url', path, connections=4, min_part_size=1000)
+
+    assert session.requests[0] == 'bytes=0-0'
+    assert sorted(session.requests[1:]) == ['bytes=0-2559', 'bytes=2560-5119', 'bytes=5120-7679', 'bytes=7680-10239']
+    assert open(path, 'rb').read() == session.data
+
+
+def test_download_ranges_prefix(tmp_path):
+    session = FakeFileSession(bytes(range(256)) * 40)
+    path = str(tmp_path / 'track.flac')
+    download_ranges(session, 'url', path, connections=1, prefix=session.data[:1000], size=len(session.data))
+
+    assert session.requests == ['bytes=1000-10239']
+    assert open(path, 'rb').read() == session.data
+
+
+@pytest.mark.parametrize('session', [FakeFileSession(b'flac' * 1000, ranges=False), NoProbeSession(b'flac' * 1000)])
+def test_download_ranges_single_stream(tmp_path, session):
+    # a server without range support or a failed probe fall back to a single stream instead of failing the track
+    path = str(tmp_path / 'track.flac')
+    download_ranges(session, 'url', path, connections=4, min_part_size=100)
+
+    assert session.requests[-1] is None
+    assert open(path, 'rb').read() == session.data
+
+
+
+class TruncatingFileSession(FakeFileSession):
+    # a server without range support whose first whole file response ends early
+    def get(self, url, headers=None, stream=False):
+        r = super(TruncatingFileSession, self).get(url, headers, stream)
+        if self.requests.count(None) == 1:
+            r.body = r.body[:1500]
+        return r
+
+
+def test_download_ranges_single_stream_truncated(tmp_path):
+    # the truncated stream is detected with the Content-Length and retried
+    session = TruncatingFileSession(b'flac' * 1000, ranges=False)
+    path = str(tmp_path / 'track.flac')
+    download_ranges(session, 'url', path, connections=4, min_part_size=100)
+
+    assert session.requests == ['bytes=0-0', None, None]
+    assert open(path, 'rb').read() == session.data
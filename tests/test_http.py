@@ -0,0 +1,130 @@
+import json
+import threading
+import time
+
+import pytest
+
+from orpheus_tidal.tidal_api import TidalApi, SessionType
+from orpheus_tidal.tidal_http import TokenBucket, RequestScheduler, SingleFlight, ApiMetrics
+
+
+class FakeSession:
+    country_code = 'US'
+
+    def auth_headers(self):
+        return {'Authorization': 'Bearer token'}
+
+
+class FakeResponse:
+    def __init__(self, body, status_code=200, headers=None):
+        self.content = json.dumps(body).encode()
+        self.status_code = status_code
+        self.headers = headers or {}
+
+
+class FakeApiSession:
+    def __init__(self):
+        self.urls = []
+
+    def get(self, url, headers=None, params=None):
+        self.urls.append(url)
+        return FakeResponse({'id': 1})
+
+
+class FakePools:
+    transient_errors = (ConnectionError,)
+
+    def __init__(self):
+        self.api = FakeApiSession()
+
+
+def test_token_bucket_without_rate_is_unlimited():
+    for rate in (None, 0):
+        bucket = TokenBucket(rate)
+        assert all(bucket.reserve() == 0 for _ in range(100))
+
+
+def test_token_bucket_throttles_after_burst():
+    bucket = TokenBucket(10)
+    delays = [bucket.reserve() for _ in range(11)]
+    assert all(delay == 0 for delay in delays[:10])
+    assert delays[10] == pytest.approx(0.1, abs=0.01)
+
+
+@pytest.mark.parametrize('rates', [None, {}, {'TV': 10}, {'MOBILE_ATMOS': None}, 0])
+def test_scheduler_missing_or_none_rates_are_unlimited(rates):
+    scheduler = RequestScheduler(rates)
+    for session_type in SessionType:
+        if isinstance(rates, dict) and rates.get(session_type.name):
+            continue
+        assert all(scheduler.reserve(session_type.name) == 0 for _ in range(20))
+
+
+def test_scheduler_accepts_one_rate_for_all_session_types():
+    scheduler = RequestScheduler(5)
+    for session_type in SessionType:
+        assert scheduler._bucket(session_type.name).rate == 5
+        assert scheduler._bucket(session_type.name) is not scheduler._bucket('OTHER')
+
+
+def test_scheduler_retries_throttled_and_failed_requests():
+    scheduler = RequestScheduler({'TV': 10}, max_retries=2)
+    assert scheduler.retry_delay('TV', 0, 200) is None
+    assert scheduler.retry_delay('TV', 0, 404) is None
+    assert scheduler.retry_delay('TV', 0, 503) is not None
+    assert scheduler.retry_delay('TV', 0, 429, '3') == 3
+    assert scheduler.retry_delay('TV', 2, 503) is None
+
+
+def test_api_with_default_scheduler_and_single_session():
+    pools = FakePools()
+    api = TidalApi({'TV': FakeSession()}, pools=pools)
+
+    assert api.get_album(1) == {'id': 1}
+    assert pools.api.urls == [TidalApi.TIDAL_API_BASE + 'albums/1']
+
+
+def test_single_flight_returns_copies():
+    flight = SingleFlight()
+    started, release = threading.Event(), threading.Event()
+    calls = []
+
+    def fetch():
+        calls.append(1)
+        started.set()
+        assert release.wait(5)
+        return {'tracks': [1, 2]}
+
+    results = [None] * 8
+
+    def worker(i):
+        results[i] = flight.do('key', fetch)
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(len(results))]
+    threads[0].start()
+    assert started.wait(5)
+    for thread in threads[1:]:
+        thread.start()
+    # let the leader return once every other caller waits for it
+    deadline = time.monotonic() + 5
+    while flight.calls['key'].waiters < len(results) - 1:
+        assert time.monotonic() < deadline
+        time.sleep(0.001)
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    assert len(calls) == 1
+    assert all(result == {'tracks': [1, 2]} for result in results)
+    assert len({id(result) for result in results}) == len(results)
+
+    results[0]['tracks'].append(3)
+    assert all(result == {'tracks': [1, 2]} for result in results[1:])
+
+
+def test_metrics_group_ids_into_templates():
+    metrics = ApiMetrics()
+    metrics.record_request('albums/123/items/credits', 200, 0.1, 10)
+    metrics.record_request('albums/456/items/credits', 404, 0.2, 5)
+
+    assert list(metrics.as_dict()) == ['albums/{id}/items/credits']
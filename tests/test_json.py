@@ -0,0 +1,29 @@
+import pytest
+
+from orpheus_tidal import tidal_api
+
+
+@pytest.fixture(params=['orjson', 'json'])
+def loads_json(request, monkeypatch):
+    if request.param == 'orjson' and tidal_api.orjson is None:
+        pytest.skip('orjson is not installed')
+    if request.param == 'json':
+        monkeypatch.setattr(tidal_api, 'orjson', None)
+    return tidal_api.loads_json
+
+
+def test_loads_json(loads_json):
+    assert loads_json(b'{"id": 1, "title": "\xc3\xa9"}') == {'id': 1, 'title': 'é'}
+
+
+def test_loads_json_leading_whitespace(loads_json):
+    assert loads_json(b'\n  {"id": 1}') == {'id': 1}
+
+
+def test_loads_json_invalid(loads_json):
+    with pytest.raises(ValueError):
+        loads_json(b'<html>Bad Gateway</html>')
+
+
+def test_loads_json_bom(loads_json):
+    assert loads_json(b'\xef\xbb\xbf{"id": 1}') == {'id': 1}
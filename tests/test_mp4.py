@@ -0,0 +1,249 @@
+import io
+import os
+import struct
+
+import pytest
+
+from orpheus_tidal.tidal_mp4 import FlacDemuxer, Mp4Error, find_box
+
+# synthetic fragmented MP4 (MPEG-DASH) FLAC streams like TIDAL serves them, with valid FLAC frames so
+# benchmarks/bench_mp4.py can feed the same data to ffmpeg
+
+SAMPLE_RATE = 44100
+
+
+def _crc_table(poly: int, bits: int):
+    table = []
+    for byte in range(256):
+        crc = byte << (bits - 8)
+        for _ in range(8):
+            crc = (crc << 1) ^ poly if crc & (1 << (bits - 1)) else crc << 1
+        table.append(crc & ((1 << bits) - 1))
+    return table
+
+
+CRC8_TABLE, CRC16_TABLE = _crc_table(0x07, 8), _crc_table(0x8005, 16)
+
+
+def crc8(data: bytes) -> int:
+    crc = 0
+    for byte in data:
+        crc = CRC8_TABLE[crc ^ byte]
+    return crc
+
+
+def crc16(data: bytes) -> int:
+    crc = 0
+    for byte in data:
+        crc = ((crc << 8) & 0xFFFF) ^ CRC16_TABLE[(crc >> 8) ^ byte]
+    return crc
+
+
+def coded_number(number: int) -> bytes:
+    # frame numbers are coded like UTF-8, but up to 36 bits
+    if number < 0x80:
+        return bytes([number])
+    length = 2
+    while number >= 1 << (6 * (length - 1) + 7 - length):
+        length += 1
+    first = (0xFF << (8 - length)) & 0xFF | number >> (6 * (length - 1))
+    return bytes([first] + [0x80 | (number >> (6 * i)) & 0x3F for i in reversed(range(length - 1))])
+
+
+def flac_frame(number: int, block_size: int) -> bytes:
+    # fixed block size, 44.1 kHz, 16 bit stereo with random verbatim subframes
+    header = b'\xff\xf8' + bytes([0x79, 0x18]) + coded_number(number) + (block_size - 1).to_bytes(2, 'big')
+    frame = header + bytes([crc8(header)])
+    for _ in range(2):
+        frame += b'\x02' + os.urandom(block_size * 2)
+    return frame + crc16(frame).to_bytes(2, 'big')
+
+
+def box(box_type: bytes, *payload: bytes) -> bytes:
+    payload = b''.join(payload)
+    return struct.pack('>I4s', 8 + len(payload), box_type) + payload
+
+
+def full_box(box_type: bytes, version: int, flags: int, *payload: bytes) -> bytes:
+    return box(box_type, bytes([version]) + flags.to_bytes(3, 'big'), *payload)
+
+
+def metadata_block(block_type: int, data: bytes, last: bool = False) -> bytes:
+    return bytes([block_type | (0x80 if last else 0)]) + len(data).to_bytes(3, 'big') + data
+
+
+def streaminfo(block_size: int, total_samples: int = 0) -> bytes:
+    value = SAMPLE_RATE << 44 | (2 - 1) << 41 | (16 - 1) << 36 | total_samples
+    return struct.pack('>HH', block_size, block_size) + b'\0' * 6 + value.to_bytes(8, 'big') + b'\0' * 16
+
+
+def init_segment(blocks: bytes, timescale: int = SAMPLE_RATE) -> bytes:
+    matrix = struct.pack('>9I', 0x10000, 0, 0, 0, 0x10000, 0, 0, 0, 0x40000000)
+    entry = (b'\0' * 6 + struct.pack('>H', 1) + b'\0' * 8 + struct.pack('>HHHHI', 2, 16, 0, 0, SAMPLE_RATE << 16)
+             + full_box(b'dfLa', 0, 0, blocks))
+    stbl = box(b'stbl',
+               full_box(b'stsd', 0, 0, struct.pack('>I', 1), box(b'fLaC', entry)),
+               full_box(b'stts', 0, 0, struct.pack('>I', 0)),
+               full_box(b'stsc', 0, 0, struct.pack('>I', 0)),
+               full_box(b'stsz', 0, 0, struct.pack('>II', 0, 0)),
+               full_box(b'stco', 0, 0, struct.pack('>I', 0)))
+    minf = box(b'minf',
+               full_box(b'smhd', 0, 0, b'\0' * 4),
+               box(b'dinf', full_box(b'dref', 0, 0, struct.pack('>I', 1), full_box(b'url ', 0, 1))),
+               stbl)
+    mdia = box(b'mdia',
+               full_box(b'mdhd', 0, 0, struct.pack('>IIIIHH', 0, 0, timescale, 0, 0x55C4, 0)),
+               full_box(b'hdlr', 0, 0, b'\0' * 4, b'soun', b'\0' * 12, b'SoundHandler\0'),
+               minf)
+    trak = box(b'trak',
+               full_box(b'tkhd', 0, 3, struct.pack('>IIIII', 0, 0, 1, 0, 0), b'\0' * 8,
+                        struct.pack('>HHHH', 0, 0, 0x100, 0), matrix, b'\0' * 8),
+               mdia)
+    moov = box(b'moov',
+               full_box(b'mvhd', 0, 0, struct.pack('>IIIIIH', 0, 0, timescale, 0, 0x10000, 0x100), b'\0' * 10,
+                        matrix, b'\0' * 24, struct.pack('>I', 2)),
+               trak,
+               box(b'mvex', full_box(b'trex', 0, 0, struct.pack('>IIIII', 1, 1, 0, 0, 0))))
+    return box(b'ftyp', b'iso6', b'\0\0\0\0', b'iso6dash') + moov
+
+
+def fragment(runs: list, sequence: int = 1, start: int = 0, explicit_offsets: bool = True, tfhd_flags: int = 0x20000,
+             duration: int = 0) -> bytes:
+    # one traf with a trun per run of frames, only the first trun has a data offset unless explicit_offsets is set
+    def moof(first_offset: int) -> bytes:
+        truns, offset = [], first_offset
+        for index, frames in enumerate(runs):
+            has_offset = index == 0 or explicit_offsets
+            entries = b''.join(struct.pack('>II', duration, len(frame)) for frame in frames)
+            if has_offset:
+                truns.append(full_box(b'trun', 0, 0x301, struct.pack('>Ii', len(frames), offset), entries))
+            else:
+                truns.append(full_box(b'trun', 0, 0x300, struct.pack('>I', len(frames)), entries))
+            offset += sum(map(len, frames))
+
+        tfhd = struct.pack('>I', 1) + (struct.pack('>Q', 0) if tfhd_flags & 0x01 else b'')
+        return box(b'moof',
+                   full_box(b'mfhd', 0, 0, struct.pack('>I', sequence)),
+                   box(b'traf', full_box(b'tfhd', 0, tfhd_flags, tfhd), full_box(b'tfdt', 1, 0, struct.pack('>Q', start)),
+                       *truns))
+
+    # the data offsets are relative to the moof box and point behind the mdat header
+    data_offset = len(moof(0)) + 8
+    return box(b'styp', b'msdh', b'\0\0\0\0', b'msdh') + moof(data_offset) + box(b'mdat', *(
+        frame for frames in runs for frame in frames))
+
+
+def flac_stream(segments: int, frames: int = 4, block_size: int = 192, blocks: bytes = None, duration: int = None,
+                **kwargs):
+    # returns the fragmented MP4 segments and the FLAC frames they contain, sample durations default to the block size
+    if blocks is None:
+        blocks = metadata_block(0, streaminfo(block_size)) + metadata_block(4, b'\0' * 8, last=True)
+
+    data, all_frames = [init_segment(blocks)], []
+    for segment in range(segments):
+        numbers = range(segment * frames, (segment + 1) * frames)
+        segment_frames = [flac_frame(number, block_size) for number in numbers]
+        data.append(fragment([segment_frames], segment + 1, numbers[0] * block_size, duration=duration or block_size,
+                             **kwargs))
+        all_frames += segment_frames
+    return data, all_frames
+
+
+def demux(segments, chunk_size: int = None) -> bytes:
+    output = io.BytesIO()
+    demuxer = FlacDemuxer(output.write)
+    data = b''.join(segments)
+    for start in range(0, len(data), chunk_size or len(data)):
+        demuxer.feed(data[start:start + (chunk_size or len(data))])
+    demuxer.close()
+    demuxer.patch_streaminfo(output)
+    return output.getvalue()
+
+
+def total_samples(flac: bytes) -> int:
+    return int.from_bytes(flac[18:26], 'big') & 0xFFFFFFFFF
+
+
+def test_demux():
+    segments, frames = flac_stream(3)
+    flac = demux(segments)
+
+    header = b'fLaC' + metadata_block(0, streaminfo(192, 3 * 4 * 192)) + metadata_block(4, b'\0' * 8, last=True)
+    assert flac == header + b''.join(frames)
+    assert total_samples(flac) == 3 * 4 * 192
+
+
+@pytest.mark.parametrize('chunk_size', [1, 7, 777, 4096])
+def test_demux_chunked(chunk_size):
+    # segments split at any position, e.g. inside a box header or between a moof box and its mdat box
+    segments, frames = flac_stream(3)
+    assert demux(segments, chunk_size) == demux(segments)
+
+
+@pytest.mark.parametrize('explicit_offsets', [True, False])
+def test_demux_multiple_runs(explicit_offsets):
+    frames = [flac_frame(number, 192) for number in range(6)]
+    blocks = metadata_block(0, streaminfo(192), last=True)
+    segments = [init_segment(blocks), fragment([frames[:1], frames[1:4], frames[4:]], explicit_offsets=explicit_offsets,
+                                               duration=192)]
+
+    flac = demux(segments, 100)
+    assert flac[42:] == b''.join(frames)
+    assert total_samples(flac) == 6 * 192
+
+
+def test_demux_trun_outside_mdat():
+    segment = bytearray(fragment([[flac_frame(0, 192)]], duration=192))
+    # move the data offset of the run behind the mdat box
+    trun = find_box(segment, [b'moof', b'traf', b'trun'], 0)
+    struct.pack_into('>i', segment, trun[0] + 8, len(segment))
+
+    with pytest.raises(Mp4Error):
+        demux([init_segment(metadata_block(0, streaminfo(192), last=True)), bytes(segment)])
+
+
+def test_demux_rejects_absolute_base_offset():
+    # tfhd flag 0x01, the base data offset is relative to the start of the file
+    segments, _ = flac_stream(1, tfhd_flags=0x01)
+    with pytest.raises(Mp4Error, match='Absolute base data offsets'):
+        demux(segments)
+
+
+@pytest.mark.parametrize('blocks, expected', [
+    # only STREAMINFO, without the last-metadata-block flag
+    (metadata_block(0, streaminfo(192)), metadata_block(0, streaminfo(192, 192), last=True)),
+    # the flag is set on STREAMINFO instead of the last block
+    (metadata_block(0, streaminfo(192), last=True) + metadata_block(4, b'\0' * 8),
+     metadata_block(0, streaminfo(192, 192)) + metadata_block(4, b'\0' * 8, last=True)),
+    (metadata_block(0, streaminfo(192)) + metadata_block(1, b'\0' * 4) + metadata_block(4, b'\0' * 8),
+     metadata_block(0, streaminfo(192, 192)) + metadata_block(1, b'\0' * 4) + metadata_block(4, b'\0' * 8, last=True)),
+])
+def test_demux_last_metadata_block(blocks, expected):
+    segments, frames = flac_stream(1, frames=1, blocks=blocks)
+    assert demux(segments) == b'fLaC' + expected + b''.join(frames)
+
+
+def test_demux_keeps_total_samples():
+    segments, _ = flac_stream(1, blocks=metadata_block(0, streaminfo(192, 1234), last=True))
+    assert total_samples(demux(segments)) == 1234
+
+
+def test_demux_timescale():
+    # sample durations in a media timescale of twice the sample rate
+    segments, _ = flac_stream(2, duration=2 * 192)
+    segments[0] = init_segment(metadata_block(0, streaminfo(192), last=True), timescale=2 * SAMPLE_RATE)
+    assert total_samples(demux(segments)) == 2 * 4 * 192
+
+
+def test_demux_incomplete_stream():
+    segments, _ = flac_stream(2)
+    data = b''.join(segments)[:-10]
+    demuxer = FlacDemuxer(lambda data: None)
+    demuxer.feed(data)
+    with pytest.raises(Mp4Error, match='Incomplete fragment'):
+        demuxer.close()
+
+
+def test_demux_requires_flac_init_segment():
+    with pytest.raises(Mp4Error, match='No FLAC init segment'):
+        FlacDemuxer(lambda data: None).close()
@@ -0,0 +1,117 @@
+import re
+
+import pytest
+
+from orpheus_tidal.tidal_mpd import MpdError, parse_iso_duration, parse_mpd
+
+
+def parse_mpd_list(xml: bytes) -> list:
+    # the parser before AudioTrack.iter_urls(), which built a list with every url of a track. It ignored $Time$, here
+    # the segment start times it already computed are filled in
+    from xml.etree import ElementTree
+
+    root = ElementTree.fromstring(re.sub(r'xmlns="[^"]+"', '', xml.decode('UTF-8'), count=1))
+    tracks = []
+    for rep in root.iter('Representation'):
+        seg_template = rep.find('SegmentTemplate')
+        track_urls = [seg_template.get('initialization')]
+        start_number = int(seg_template.get('startNumber') or 1)
+
+        seg_time_list = []
+        cur_time = 0
+        for s in seg_template.find('SegmentTimeline').findall('S'):
+            if s.get('t'):
+                cur_time = int(s.get('t'))
+            for i in range((int(s.get('r') or 0) + 1)):
+                seg_time_list.append(cur_time)
+                cur_time += int(s.get('d'))
+
+        track_urls += [seg_template.get('media').replace('$Number$', str(number)).replace('$Time$', str(time))
+                       for number, time in zip(range(start_number, len(seg_time_list) + start_number), seg_time_list)]
+        tracks.append(track_urls)
+    return tracks
+
+
+def timeline_mpd(segments: int, media: str = '$Number$.mp4', start_number: int = 1) -> bytes:
+    # a TIDAL like MPD, a few segments have a different duration and the timeline restarts once with @t
+    timeline = ''.join(f'<S d="{4 * 96000 + (17 if i % 7 == 0 else 0)}" r="{i % 3}"/>' for i in range(segments // 2))
+    timeline = f'<S t="1000" d="{4 * 96000}" r="2"/>{timeline}<S t="999999999" d="96000"/>'
+    return f'''<?xml version='1.0' encoding='UTF-8'?>
+<MPD xmlns="urn:mpeg:dash:schema:mpd:2011" mediaPresentationDuration="PT8H20M" type="static">
+  <Period id="0">
+    <AdaptationSet contentType="audio" mimeType="audio/mp4" segmentAlignment="true">
+      <Representation id="FLAC,96000,24" codecs="flac" bandwidth="4000000" audioSamplingRate="96000">
+        <SegmentTemplate timescale="96000" initialization="https://sp-ad-cf.audio.tidal.com/mediatracks/abc/0.mp4?token=x"
+            media="https://sp-ad-cf.audio.tidal.com/mediatracks/abc/{media}?token=x" startNumber="{start_number}">
+          <SegmentTimeline>{timeline}</SegmentTimeline>
+        </SegmentTemplate>
+      </Representation>
+    </AdaptationSet>
+  </Period>
+</MPD>'''.encode()
+
+
+def duration_mpd(mpd_duration: str = None, period_duration: str = None) -> bytes:
+    mpd_duration = f' mediaPresentationDuration="{mpd_duration}"' if mpd_duration else ''
+    period_duration = f' duration="{period_duration}"' if period_duration else ''
+    return f'''<MPD xmlns="urn:mpeg:dash:schema:mpd:2011"{mpd_duration}><Period{period_duration}>
+<AdaptationSet contentType="audio"><SegmentTemplate timescale="44100" duration="176400"
+initialization="$RepresentationID$/0.mp4" media="$RepresentationID$/$Number$.mp4"/>
+<Representation id="mp4a.40.2" codecs="mp4a.40.2" bandwidth="320000"/></AdaptationSet></Period></MPD>'''.encode()
+
+
+@pytest.mark.parametrize('media', ['$Number$.mp4', '$Time$.mp4', '$Number$_$Time$.mp4'])
+@pytest.mark.parametrize('start_number', [0, 1, 5])
+def test_iter_urls_matches_url_list(media, start_number):
+    xml = timeline_mpd(10000, media, start_number)
+    track, = parse_mpd(xml)
+    urls, = parse_mpd_list(xml)
+
+    assert len(track) == len(urls)
+    assert list(track.iter_urls()) == urls
+    for start in (1, 2, 1000, len(urls) - 1, len(urls)):
+        assert list(track.iter_urls(start)) == urls[start:]
+
+
+def test_number_template_has_no_timeline():
+    track, = parse_mpd(timeline_mpd(100))
+    assert track.timeline is None
+    assert parse_mpd(timeline_mpd(100, '$Time$.mp4'))[0].timeline is not None
+
+
+@pytest.mark.parametrize('mpd_duration, period_duration', [('PT3M25.5S', None), ('PT1H', 'PT3M25.5S')])
+def test_duration_template(mpd_duration, period_duration):
+    # 205.5 s in segments of 4 s, the Period duration takes precedence over the presentation duration
+    track, = parse_mpd(duration_mpd(mpd_duration, period_duration))
+
+    assert track.codec == 'AAC'
+    assert list(track.iter_urls()) == ['mp4a.40.2/0.mp4'] + [f'mp4a.40.2/{number}.mp4' for number in range(1, 53)]
+    assert list(track.iter_urls(52)) == ['mp4a.40.2/52.mp4']
+
+
+def test_duration_template_without_duration():
+    with pytest.raises(MpdError, match='without a Period or presentation duration'):
+        parse_mpd(duration_mpd())
+
+
+def test_video_representation():
+    with pytest.raises(MpdError):
+        parse_mpd(timeline_mpd(10).replace(b'contentType="audio"', b'contentType="video"'))
+
+
+def test_codec_enum():
+    track, = parse_mpd(timeline_mpd(10), {'FLAC': 'CodecEnum.FLAC'})
+    assert (track.codec, track.sample_rate, track.bitrate) == ('CodecEnum.FLAC', 96000, 4000000)
+
+
+@pytest.mark.parametrize('duration, seconds', [
+    ('PT3M25.512S', 205.512), ('PT8H20M', 30000), ('P1DT1S', 86401), ('PT0S', 0), ('P0D', 0)
+])
+def test_parse_iso_duration(duration, seconds):
+    assert parse_iso_duration(duration) == pytest.approx(seconds)
+
+
+@pytest.mark.parametrize('duration', ['', '3M25S', 'PT3X', None])
+def test_parse_iso_duration_invalid(duration):
+    with pytest.raises(MpdError):
+        parse_iso_duration(duration)
@@ -0,0 +1,204 @@
+import random
+
+import pytest
+
+from orpheus_tidal.tidal_cache import SqliteStore
+from orpheus_tidal.tidal_sync import SyncTracker, TrackState, diff_playlist, iter_new_albums, moved_tracks
+
+
+def items(*track_ids):
+    return [{'id': track_id, 'title': f'Track {track_id}'} for track_id in track_ids]
+
+
+def test_diff_playlist():
+    diff = diff_playlist([1, 2, 3, 4], items(5, 1, 3, 2, 6))
+    assert diff.added == [5, 6]
+    assert diff.removed == [4]
+    # either 2 or 3 moved, the tracks of the last longest sequence are kept
+    assert diff.moved == [3]
+    assert diff.data == {5: {'id': 5, 'title': 'Track 5'}, 6: {'id': 6, 'title': 'Track 6'}}
+
+
+def test_diff_playlist_first_run():
+    diff = diff_playlist([], items(1, 2, 3))
+    assert (diff.added, diff.removed, diff.moved) == ([1, 2, 3], [], [])
+
+
+def test_diff_playlist_duplicates():
+    # a track can be added to a playlist several times, it's only downloaded once
+    diff = diff_playlist([1, 1, 2], items(3, 1, 3, 2, 1))
+    assert (diff.added, diff.removed, diff.moved) == ([3], [], [])
+
+
+def test_diff_playlist_pending():
+    # pending tracks of the last run are added again, unless they were removed from the playlist
+    diff = diff_playlist([1, 2, 3, 4], items(1, 2, 3, 5), pending=[2, 4])
+    assert diff.added == [2, 5]
+    assert diff.removed == [4]
+    assert set(diff.data) == {2, 5}
+
+
+@pytest.mark.parametrize('old_tracks, new_tracks, moved', [
+    ([], [], []),
+    ([1, 2, 3], [1, 2, 3], []),
+    # one track moved to the front or the back
+    ([1, 2, 3, 4], [4, 1, 2, 3], [4]),
+    ([1, 2, 3, 4], [2, 3, 4, 1], [1]),
+    # two tracks swapped, one of them stays
+    ([1, 2, 3, 4, 5], [1, 4, 3, 2, 5], [4, 3]),
+    # added and removed tracks don't count as moved
+    ([1, 2, 3], [0, 3, 2, 9], [3]),
+    # the first position of duplicates is used
+    ([1, 2, 1, 3], [2, 1, 3], [2]),
+])
+def test_moved_tracks(old_tracks, new_tracks, moved):
+    assert moved_tracks(old_tracks, new_tracks) == moved
+
+
+def test_moved_tracks_reversed():
+    # only one track of a reversed playlist can keep its relative order
+    assert len(moved_tracks(list(range(100)), list(reversed(range(100))))) == 99
+
+
+def test_moved_tracks_is_minimal():
+    # the kept tracks are the longest increasing subsequence, checked against a quadratic solution
+    rng = random.Random(4)
+    for _ in range(50):
+        old_tracks = rng.sample(range(1000), 60)
+        new_tracks = old_tracks[:]
+        for _ in range(rng.randrange(10)):
+            new_tracks.insert(rng.randrange(len(new_tracks)), new_tracks.pop(rng.randrange(len(new_tracks))))
+
+        positions = [old_tracks.index(track) for track in new_tracks]
+        longest = [1] * len(positions)
+        for i in range(len(positions)):
+            for j in range(i):
+                if positions[j] < positions[i]:
+                    longest[i] = max(longest[i], longest[j] + 1)
+
+        moved = moved_tracks(old_tracks, new_tracks)
+        assert len(moved) == len(new_tracks) - max(longest)
+        kept = [old_tracks.index(track) for track in new_tracks if track not in moved]
+        assert kept == sorted(kept)
+
+
+def pages(albums, requested):
+    def fetch_page(offset, limit):
+        requested.append(offset)
+        return {'items': albums[offset:offset + limit], 'totalNumberOfItems': len(albums)}
+    return fetch_page
+
+
+def test_iter_new_albums_stops_at_watermark():
+    albums = [{'id': 100 - i, 'releaseDate': f'2020-01-{31 - i // 4:02d}'} for i in range(100)]
+    known = {str(album['id']) for album in albums[3:]}
+    requested = []
+
+    new = list(iter_new_albums(pages(albums, requested), known, ['2020-01-31', 97], limit=10))
+    assert [album['id'] for album in new] == [100, 99, 98]
+    assert requested == [0]
+
+
+def test_iter_new_albums_without_watermark():
+    # without a watermark every page is fetched, e.g. for stores of older versions
+    albums = [{'id': i, 'releaseDate': '2020-01-01'} for i in range(25)]
+    requested = []
+
+    new = list(iter_new_albums(pages(albums, requested), {'3', '20'}, None, limit=10))
+    assert len(new) == 23
+    assert requested == [0, 10, 20]
+
+
+@pytest.fixture
+def stores(tmp_path):
+    path = str(tmp_path / 'store.db')
+    return SqliteStore(path, 'artist_sync'), SqliteStore(path, 'playlist_sync')
+
+
+def test_sync_tracker_playlist(stores):
+    _, playlist_store = stores
+    playlist_store.set('p', {'lastUpdated': 1, 'numberOfTracks': 3, 'tracks': [1, 2, 3], 'pending': [1, 2, 3]})
+    tracker = SyncTracker(*stores)
+    tracker.watch_playlist('p', [1, 2, 3])
+
+    tracker.set_track_state(1, TrackState.HANDLED)
+    tracker.set_track_state('2', TrackState.DOWNLOADING)
+    tracker.set_track_state(3, TrackState.FAILED)
+    tracker.flush()
+    assert playlist_store.get('p')['pending'] == [2, 3]
+
+    # the interrupted download finished
+    tracker.set_track_state(2, TrackState.HANDLED)
+    tracker.flush()
+    assert playlist_store.get('p') == {'lastUpdated': 1, 'numberOfTracks': 3, 'tracks': [1, 2, 3], 'pending': [3]}
+
+
+def test_sync_tracker_started_track(stores):
+    # a returned URL is downloaded by OrpheusDL after get_track_download, only the next item acknowledges the track
+    _, playlist_store = stores
+    playlist_store.set('p', {'lastUpdated': 1, 'numberOfTracks': 2, 'tracks': [1, 2], 'pending': [1, 2]})
+    tracker = SyncTracker(*stores)
+    tracker.watch_playlist('p', [1, 2])
+
+    tracker.set_track_state(1, TrackState.STARTED)
+    tracker.flush()
+    assert playlist_store.get('p')['pending'] == [1, 2]
+
+    tracker.advance()
+    tracker.set_track_state(2, TrackState.STARTED)
+    tracker.flush()
+    assert playlist_store.get('p')['pending'] == [2]
+
+    # the run was interrupted, the exit flush doesn't acknowledge the last track
+    tracker.flush()
+    assert playlist_store.get('p')['pending'] == [2]
+
+
+def test_sync_tracker_artist(stores):
+    artist_store, _ = stores
+    artist_store.set('a', {'albums': ['1'], 'pending': ['2', '3', '4'], 'watermark': ['2020-01-01', 4]})
+    tracker = SyncTracker(*stores)
+    tracker.watch_artist('a', {'2', '3', '4'})
+
+    # album 2 is complete, one track of album 3 failed and album 4 was never fetched
+    tracker.set_album_tracks('2', ['20', '21'])
+    tracker.set_album_tracks('3', ['30', '31'])
+    for track_id in ('20', '21', '30'):
+        tracker.set_track_state(track_id, TrackState.HANDLED)
+    tracker.set_track_state('31', TrackState.FAILED)
+    tracker.flush()
+
+    assert artist_store.get('a') == {'albums': ['1', '2'], 'pending': ['3', '4'], 'watermark': ['2020-01-01', 4]}
+
+
+def test_sync_tracker_unfinished_album(stores):
+    # the last track of the album was returned but OrpheusDL didn't move on, e.g. the run was interrupted
+    artist_store, _ = stores
+    artist_store.set('a', {'albums': [], 'pending': ['2'], 'watermark': None})
+    tracker = SyncTracker(*stores)
+    tracker.watch_artist('a', {'2'})
+
+    tracker.set_album_tracks('2', ['20', '21'])
+    tracker.set_track_state('20', TrackState.STARTED)
+    tracker.advance()
+    tracker.set_track_state('21', TrackState.STARTED)
+    tracker.flush()
+    assert artist_store.get('a') == {'albums': [], 'pending': ['2'], 'watermark': None}
+
+    # the next album started
+    tracker.advance()
+    tracker.flush()
+    assert artist_store.get('a') == {'albums': ['2'], 'pending': [], 'watermark': None}
+
+
+def test_sync_tracker_empty_album(stores):
+    artist_store, _ = stores
+    artist_store.set('a', {'albums': [], 'pending': ['2'], 'watermark': None})
+    tracker = SyncTracker(*stores)
+    tracker.watch_artist('a', {'2'})
+    tracker.flush()
+    assert artist_store.get('a')['pending'] == ['2']
+
+    tracker.set_album_tracks('2', [])
+    tracker.flush()
+    assert artist_store.get('a') == {'albums': ['2'], 'pending': [], 'watermark': None}
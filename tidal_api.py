@@ -1,11 +1,17 @@
 import base64
+import codecs
+import contextvars
 import hashlib
 import json
+import re
 import secrets
 import sys
+import threading
 import time
 import webbrowser
 from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from dataclasses import dataclass
 from enum import Enum, auto
 
@@ -16,7 +22,13 @@ import urllib.parse as urlparse
 from urllib.parse import parse_qs, quote
 from datetime import datetime, timedelta
 
-from utils.utils import create_requests_session
+from .tidal_cache import ResponseCache, SqliteStore
+from .tidal_http import RequestScheduler, SingleFlight, ApiMetrics, ConnectionPools, connection_pools
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 technical_names = {
     'eac3': 'E-AC-3 JOC (Dolby Digital Plus with Dolby Atmos, with 5.1 bed)',
@@ -30,6 +42,16 @@ technical_names = {
 }
 
 
+def loads_json(content: bytes):
+    # decodes the raw response bytes, with orjson if installed (about twice as fast on large responses, see
+    # benchmarks/bench_json.py). json.loads() on the bytes is at least as fast as the old resp.json(). Both decoders
+    # accept the leading whitespace and UTF-8 BOM some responses have and raise a ValueError on invalid JSON
+    if orjson is not None:
+        # unlike json.loads() and resp.json(), orjson rejects a UTF-8 BOM
+        return orjson.loads(content[3:] if content.startswith(codecs.BOM_UTF8) else content)
+    return json.loads(content)
+
+
 class TidalRequestError(Exception):
     def __init__(self, payload):
         sf = '{subStatus}: {userMessage} (HTTP {status})'.format(**payload)
@@ -59,63 +81,193 @@ class TidalApi(object):
     TIDAL_VIDEO_BASE = 'https://api.tidalhifi.com/v1/'
     TIDAL_CLIENT_VERSION = '2.26.1'
 
-    def __init__(self, sessions: dict):
+    # cache lifetime in seconds for every endpoint, the first matching pattern wins, None means never cache
+    CACHE_TTLS = [
+        (re.compile(r'tracks/\d+/playbackinfopostpaywall'), None),
+        (re.compile(r'videos/\d+/streamurl'), None),
+        (re.compile(r'users/'), None),
+        (re.compile(r'albums/\d+/items/credits'), 7 * 24 * 3600),
+        (re.compile(r'(tracks|videos)/\d+/(contributors|lyrics)'), 7 * 24 * 3600),
+        (re.compile(r'artists/\d+/albums'), 6 * 3600),
+        (re.compile(r'playlists/'), 10 * 60),
+        (re.compile(r'(search|pages/)'), 3600),
+        (re.compile(r'(albums|tracks|videos|artists)'), 24 * 3600),
+    ]
+
+    def __init__(self, sessions: dict, cache: ResponseCache = None, max_workers: int = 8,
+                 scheduler: RequestScheduler = None, id_types: SqliteStore = None, pools: ConnectionPools = None):
         self.sessions = sessions
-        self.default: SessionType = SessionType.TV  # Change to TV or MOBILE depending on AC-4/360RA
+        # session type used if no other one is selected with use_session() or passed to _get()
+        self.default: SessionType = SessionType.TV
+        # context local session type set by use_session(), safe to use from multiple threads or asyncio tasks
+        self.session_override = contextvars.ContextVar('session_type', default=None)
+        # only one thread refreshes a session's token after a 401/403
+        self.refresh_locks = {session_type.name: threading.Lock() for session_type in SessionType}
+        self.cache = cache
+        # persistent id -> type ('a', 'r', 't' or 'v') index filled by get_type_from_id()
+        self.id_types = id_types
+        # maximum number of concurrent requests used for pagination
+        self.max_workers = max_workers
+        # rate limits and retries all requests, see self.scheduler.stats() for the throttled time
+        self.scheduler = scheduler if scheduler is not None else RequestScheduler()
+        # identical concurrent requests share one HTTP request
+        self.single_flight = SingleFlight()
+        # per endpoint request counts, status codes, latencies, bytes, retries and token refreshes
+        self.metrics = ApiMetrics()
+
+        # shared API connection pool, the scheduler handles all retries so urllib3 doesn't retry on its own
+        self.pools = pools if pools is not None else connection_pools
+        self.s = self.pools.api
+
+    @contextmanager
+    def use_session(self, session_type: SessionType):
+        # selects the session type (e.g. MOBILE_ATMOS for AC-4) for all requests in this thread/task and its pages
+        token = self.session_override.set(session_type)
+        try:
+            yield
+        finally:
+            self.session_override.reset(token)
 
-        self.s = create_requests_session()
+    def current_session_type(self) -> SessionType:
+        return self.session_override.get() or self.default
+
+    def _submit(self, executor: ThreadPoolExecutor, fn, *args):
+        # worker threads don't inherit the context, so copy it to keep the session type selected by use_session()
+        return executor.submit(contextvars.copy_context().run, fn, *args)
+
+    def _cache_ttl(self, url):
+        for pattern, ttl in self.CACHE_TTLS:
+            if pattern.match(url):
+                return ttl
+        return None
+
+    @staticmethod
+    def _request_key(session_type: SessionType, url, params):
+        # responses differ between the TV and mobile clients, so the session type is part of the key
+        return session_type.name + ':' + url + '?' + urlparse.urlencode(sorted(params.items()))
 
-    def _get(self, url, params=None, refresh=False):
+    def _prepare_params(self, session_type: SessionType, params):
         if params is None:
             params = {}
-        urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
-        params['countryCode'] = self.sessions[self.default.name].country_code
+        params['countryCode'] = self.sessions[session_type.name].country_code
         if 'limit' not in params:
             params['limit'] = '9999'
+        return params
 
-        resp = self.s.get(
-            self.TIDAL_API_BASE + url,
-            headers=self.sessions[self.default.name].auth_headers(),
-            params=params)
+    def _cache_lookup(self, session_type: SessionType, url, params):
+        # returns (key, ttl, entry) of the response cache, all None if the url shouldn't be cached
+        if self.cache is None:
+            return None, None, None
 
-        # if the request 401s or 403s, try refreshing the TV/Mobile session in case that helps
-        if not refresh and (resp.status_code == 401 or resp.status_code == 403):
-            self.sessions[self.default.name].refresh()
-            return self._get(url, params, True)
+        cache_ttl = self._cache_ttl(url)
+        if not cache_ttl:
+            return None, None, None
+
+        cache_key = self._request_key(session_type, url, params)
+        return cache_key, cache_ttl, self.cache.get(cache_key)
 
-        resp_json = None
+    @staticmethod
+    def _parse_response(status_code: int, content: bytes):
         try:
-            resp_json = resp.json()
-        except:  # some tracks seem to return a JSON with leading whitespace
-            try:
-                resp_json = json.loads(resp.text.strip())
-            except:  # if this doesn't work, the HTTP status probably isn't 200. Are we rate limited?
-                pass
+            resp_json = loads_json(content)
+        except ValueError:  # if this doesn't work, the HTTP status probably isn't 200. Are we rate limited?
+            resp_json = None
 
         if not resp_json:
-            raise TidalError('Response was not valid JSON. HTTP status {}. {}'.format(resp.status_code, resp.text))
+            raise TidalError('Response was not valid JSON. HTTP status {}. {}'.format(
+                status_code, content.decode('utf-8', errors='replace')))
+
+        status = resp_json.get('status') if isinstance(resp_json, dict) else None
+        if status is None or status == 200:
+            return resp_json
 
-        if 'status' in resp_json and resp_json['status'] == 404 and \
-                'subStatus' in resp_json and resp_json['subStatus'] == 2001:
+        if status == 404 and resp_json.get('subStatus') == 2001:
             raise TidalError('Error: {}. This might be region-locked.'.format(resp_json['userMessage']))
 
         # Really hacky way, pls don't copy this ever
-        if 'status' in resp_json and resp_json['status'] == 404 and \
-                'error' in resp_json and resp_json['error'] == 'Not Found':
+        if status == 404 and resp_json.get('error') == 'Not Found':
             return resp_json
 
-        if 'status' in resp_json and not resp_json['status'] == 200:
-            raise TidalRequestError(resp_json)
+        raise TidalRequestError(resp_json)
+
+    def _send(self, session_type: SessionType, url, headers, params):
+        attempt = 0
+        while True:
+            time.sleep(self.scheduler.reserve(session_type.name))
+            start = time.monotonic()
+            try:
+                resp = self.s.get(self.TIDAL_API_BASE + url, headers=headers, params=params)
+            except self.pools.transient_errors:
+                self.metrics.record_request(url, 'error', time.monotonic() - start)
+                delay = self.scheduler.retry_delay(session_type.name, attempt)
+                if delay is None:
+                    raise
+            else:
+                self.metrics.record_request(url, resp.status_code, time.monotonic() - start, len(resp.content))
+                delay = self.scheduler.retry_delay(session_type.name, attempt, resp.status_code,
+                                                   resp.headers.get('Retry-After'))
+                if delay is None:
+                    return resp
+
+            self.metrics.record_retry(url)
+            time.sleep(delay)
+            attempt += 1
+
+    def _refresh(self, session_type: SessionType, authorization: str):
+        with self.refresh_locks[session_type.name]:
+            session = self.sessions[session_type.name]
+            # another thread already refreshed the token while this one was waiting for the lock
+            if session.auth_headers()['Authorization'] != authorization:
+                return
+            session.refresh()
+
+    def _get(self, url, params=None, session_type: SessionType = None):
+        session_type = session_type or self.current_session_type()
+        params = self._prepare_params(session_type, params)
+        return self.single_flight.do(self._request_key(session_type, url, params),
+                                     lambda: self._fetch(session_type, url, params))
+
+    def _fetch(self, session_type: SessionType, url, params, refresh=False):
+        urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+
+        headers = self.sessions[session_type.name].auth_headers()
+
+        # check the response cache first, a stale entry is revalidated with its ETag/Last-Modified
+        cache_key, cache_ttl, cache_entry = self._cache_lookup(session_type, url, params)
+        if cache_entry:
+            if cache_entry.fresh():
+                self.metrics.record_cache_hit(url)
+                return loads_json(cache_entry.content)
+            headers.update(cache_entry.validators())
+
+        resp = self._send(session_type, url, headers, params)
+
+        # if the request 401s or 403s, try refreshing the TV/Mobile session in case that helps
+        if not refresh and (resp.status_code == 401 or resp.status_code == 403):
+            self.metrics.record_token_refresh(url)
+            self._refresh(session_type, headers['Authorization'])
+            return self._fetch(session_type, url, params, True)
+
+        if resp.status_code == 304 and cache_entry:
+            self.metrics.record_cache_hit(url)
+            self.cache.touch(cache_key, cache_ttl)
+            return loads_json(cache_entry.content)
+
+        resp_json = self._parse_response(resp.status_code, resp.content)
+
+        if cache_key and resp.status_code == 200:
+            self.cache.set(cache_key, resp.content, resp.headers.get('ETag'), resp.headers.get('Last-Modified'),
+                           cache_ttl)
 
         return resp_json
 
-    def get_stream_url(self, track_id, quality):
+    def get_stream_url(self, track_id, quality, session_type: SessionType = None):
         return self._get('tracks/' + str(track_id) + '/playbackinfopostpaywall/v4', {
             'playbackmode': 'STREAM',
             'assetpresentation': 'FULL',
             'audioquality': quality,
             'prefetch': 'false'
-        })
+        }, session_type=session_type)
 
     def get_search_data(self, search_term, limit=20):
         return self._get('search', params={
@@ -125,7 +277,7 @@ class TidalApi(object):
             'includeContributors': 'true'
         })
 
-    def get_page(self, pageurl, params=None):
+    def get_page(self, pageurl, params=None, session_type: SessionType = None):
         local_params = {
             'deviceType': 'TV',
             'locale': 'en_US',
@@ -135,29 +287,50 @@ class TidalApi(object):
         if params:
             local_params.update(params)
 
-        return self._get('pages/' + pageurl, params=local_params)
+        return self._get('pages/' + pageurl, params=local_params, session_type=session_type)
 
-    def get_playlist_items(self, playlist_id):
-        result = self._get('playlists/' + playlist_id + '/items', {
-            'offset': 0,
-            'limit': 100
-        })
-
-        if result['totalNumberOfItems'] <= 100:
-            return result
-
-        offset = len(result['items'])
-        while True:
-            buf = self._get('playlists/' + playlist_id + '/items', {
+    def _iter_pages(self, fetch_page, offsets):
+        # fetch all offsets concurrently and yield (offset, page) in the order they arrive
+        executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        futures = {self._submit(executor, fetch_page, offset): offset for offset in offsets}
+        try:
+            for future in as_completed(futures):
+                yield futures[future], future.result()
+        finally:
+            # the consumer stopped early or a page failed, don't fetch the remaining pages
+            for future in futures:
+                future.cancel()
+            executor.shutdown(wait=False)
+
+    def iter_playlist_items(self, playlist_id, limit: int = 100):
+        def fetch_page(offset):
+            return self._get('playlists/' + playlist_id + '/items', {
                 'offset': offset,
-                'limit': 100
+                'limit': limit
             })
-            offset += len(buf['items'])
-            result['items'] += buf['items']
 
-            if offset >= result['totalNumberOfItems']:
-                break
+        # the first page is needed to know totalNumberOfItems
+        result = fetch_page(0)
+        yield 0, result
 
+        yield from self._iter_pages(fetch_page, range(limit, result['totalNumberOfItems'], limit))
+
+    def iter_paged_list(self, data_api_path, total, limit: int = 50, session_type: SessionType = None):
+        # fetch all pages of a pagedList module concurrently, yields (offset, page) in the order they arrive
+        return self._iter_pages(lambda offset: self.get_page(data_api_path, params={
+            'limit': limit,
+            'offset': offset
+        }, session_type=session_type), range(0, total, limit))
+
+    def get_playlist_items(self, playlist_id):
+        result, pages = None, {}
+        for offset, page in self.iter_playlist_items(playlist_id):
+            if result is None:
+                result = page
+            pages[offset] = page['items']
+
+        # put the items back in the playlist order
+        result['items'] = [item for offset in sorted(pages) for item in pages[offset]]
         return result
 
     def get_playlist(self, playlist_id):
@@ -194,6 +367,14 @@ class TidalApi(object):
             'includeContributors': True
         })
 
+    def iter_album_contributors(self, album_id, limit: int = 100):
+        # the first page is needed to know totalNumberOfItems, all remaining pages are fetched concurrently
+        result = self.get_album_contributors(album_id, limit=limit)
+        yield 0, result
+
+        yield from self._iter_pages(lambda offset: self.get_album_contributors(album_id, offset=offset, limit=limit),
+                                    range(limit, result['totalNumberOfItems'], limit))
+
     def get_lyrics(self, track_id):
         return self._get('tracks/' + str(track_id) + '/lyrics', params={
             'deviceType': 'TV',
@@ -211,36 +392,47 @@ class TidalApi(object):
     def get_artist(self, artist_id):
         return self._get('artists/' + str(artist_id))
 
-    def get_artist_albums(self, artist_id):
-        return self._get('artists/' + str(artist_id) + '/albums')
+    def get_artist_albums(self, artist_id, offset: int = 0, limit: int = 9999):
+        return self._get('artists/' + str(artist_id) + '/albums', params={
+            'offset': offset,
+            'limit': limit
+        })
 
-    def get_artist_albums_ep_singles(self, artist_id):
-        return self._get('artists/' + str(artist_id) + '/albums', params={'filter': 'EPSANDSINGLES'})
+    def get_artist_albums_ep_singles(self, artist_id, offset: int = 0, limit: int = 9999):
+        return self._get('artists/' + str(artist_id) + '/albums', params={
+            'filter': 'EPSANDSINGLES',
+            'offset': offset,
+            'limit': limit
+        })
 
     def get_type_from_id(self, id_):
-        result = None
-        try:
-            result = self.get_album(id_)
-            return 'a'
-        except TidalError:
-            pass
-        try:
-            result = self.get_artist(id_)
-            return 'r'
-        except TidalError:
-            pass
-        try:
-            result = self.get_track(id_)
-            return 't'
-        except TidalError:
-            pass
+        # bare ids which were already resolved once don't need any request
+        id_type = self.id_types.get(str(id_)) if self.id_types is not None else None
+        if id_type:
+            return id_type
+
+        probes = [('a', self.get_album), ('r', self.get_artist), ('t', self.get_track), ('v', self.get_video)]
+
+        executor = ThreadPoolExecutor(max_workers=len(probes))
+        futures = [self._submit(executor, get, id_) for _, get in probes]
         try:
-            result = self.get_video(id_)
-            return 'v'
-        except TidalError:
-            pass
+            # all probes run at once, but the album > artist > track > video priority is kept
+            for (id_type, _), future in zip(probes, futures):
+                try:
+                    future.result()
+                except TidalError:
+                    continue
 
-        return result
+                if self.id_types is not None:
+                    self.id_types.set(str(id_), id_type)
+                return id_type
+        finally:
+            # cancel the probes which are no longer needed
+            for future in futures:
+                future.cancel()
+            executor.shutdown(wait=False)
+
+        return None
 
 
 @dataclass
@@ -252,6 +444,24 @@ class SessionStorage:
     country_code: str
 
 
+class LazySessions(dict):
+    """
+    dict of TidalSession objects by SessionType name, a missing session is created by factory(session_type) on first
+    access, e.g. the mobile sessions are only created, refreshed and validated once a track needs them
+    """
+    def __init__(self, factory):
+        super().__init__()
+        self.factory = factory
+        self.lock = threading.Lock()
+
+    def __missing__(self, session_type):
+        with self.lock:
+            # another thread could have created the session while this one was waiting for the lock
+            if not dict.__contains__(self, session_type):
+                self[session_type] = self.factory(session_type)
+            return dict.__getitem__(self, session_type)
+
+
 class TidalSession(ABC):
     """
     Tidal abstract session object with all (abstract) functions needed: auth_headers(), refresh(), session_type()
@@ -281,9 +491,9 @@ class TidalSession(ABC):
 
     def get_subscription(self) -> str:
         if self.access_token:
-            r = requests.get(f'https://api.tidal.com/v1/users/{self.user_id}/subscription',
-                             params={'countryCode': self.country_code},
-                             headers=self.auth_headers())
+            r = connection_pools.api.get(f'https://api.tidal.com/v1/users/{self.user_id}/subscription',
+                                         params={'countryCode': self.country_code},
+                                         headers=self.auth_headers())
             if r.status_code != 200:
                 raise TidalAuthError(r.json()['userMessage'])
 
@@ -293,15 +503,19 @@ class TidalSession(ABC):
     def auth_headers(self) -> dict:
         pass
 
-    def valid(self):
+    def valid(self, check_online: bool = False):
         """
-        Checks if session is still valid and returns True/False
+        Checks if session is still valid and returns True/False, a locally unexpired token is trusted unless
+        check_online is set
         """
-        if not isinstance(self, TidalSession):
-            if self.access_token is None or datetime.now() > self.expires:
-                return False
+        # refresh one minute before the token actually expires
+        if self.access_token is None or self.expires is None or datetime.now() > self.expires - timedelta(minutes=1):
+            return False
+
+        if not check_online:
+            return True
 
-        r = requests.get('https://api.tidal.com/v1/sessions', headers=self.auth_headers())
+        r = connection_pools.api.get('https://api.tidal.com/v1/sessions', headers=self.auth_headers())
         return r.status_code == 200
 
     @abstractmethod
@@ -427,7 +641,7 @@ class TidalMobileSession(TidalSession):
         oauth_code = parse_qs(url.query)['code'][0]
 
         # exchange access code for oauth token
-        r = requests.post(self.TIDAL_AUTH_BASE + 'oauth2/token', data={
+        r = connection_pools.auth.post(self.TIDAL_AUTH_BASE + 'oauth2/token', data={
             'code': oauth_code,
             'client_id': self.client_id,
             'grant_type': 'authorization_code',
@@ -446,7 +660,7 @@ class TidalMobileSession(TidalSession):
         self.refresh_token = r.json()['refresh_token']
         self.expires = datetime.now() + timedelta(seconds=r.json()['expires_in'])
 
-        r = requests.get('https://api.tidal.com/v1/sessions', headers=self.auth_headers())
+        r = connection_pools.api.get('https://api.tidal.com/v1/sessions', headers=self.auth_headers())
 
         if r.status_code != 200:
             raise TidalAuthError(r.text)
@@ -456,7 +670,7 @@ class TidalMobileSession(TidalSession):
 
     def refresh(self):
         assert (self.refresh_token is not None)
-        r = requests.post(self.TIDAL_AUTH_BASE + 'oauth2/token', data={
+        r = connection_pools.auth.post(self.TIDAL_AUTH_BASE + 'oauth2/token', data={
             'refresh_token': self.refresh_token,
             'client_id': self.client_id,
             'grant_type': 'refresh_token'
@@ -542,7 +756,7 @@ class TidalTvSession(TidalSession):
                 sys.stdout.flush()
                 # exchange access code for oauth token
                 time.sleep(0.2)
-            r = requests.post(self.TIDAL_AUTH_BASE + 'oauth2/token', data=data)
+            r = connection_pools.auth.post(self.TIDAL_AUTH_BASE + 'oauth2/token', data=data)
             status_code = r.status_code
             index += 1  # lists are zero indexed, we need to increase by one for the accurate count
             # backtrack the written characters, overwrite them with space, backtrack again:
@@ -558,19 +772,19 @@ class TidalTvSession(TidalSession):
         self.refresh_token = r.json()['refresh_token']
         self.expires = datetime.now() + timedelta(seconds=r.json()['expires_in'])
 
-        r = requests.get('https://api.tidal.com/v1/sessions', headers=self.auth_headers())
+        r = connection_pools.api.get('https://api.tidal.com/v1/sessions', headers=self.auth_headers())
         assert (r.status_code == 200)
         self.user_id = r.json()['userId']
         self.country_code = r.json()['countryCode']
 
-        r = requests.get('https://api.tidal.com/v1/users/{}?countryCode={}'.format(self.user_id, self.country_code),
-                         headers=self.auth_headers())
+        r = connection_pools.api.get('https://api.tidal.com/v1/users/{}?countryCode={}'.format(
+            self.user_id, self.country_code), headers=self.auth_headers())
         assert (r.status_code == 200)
         # self.username = r.json()['username']
 
     def refresh(self):
         assert (self.refresh_token is not None)
-        r = requests.post(self.TIDAL_AUTH_BASE + 'oauth2/token', data={
+        r = connection_pools.auth.post(self.TIDAL_AUTH_BASE + 'oauth2/token', data={
             'refresh_token': self.refresh_token,
             'client_id': self.client_id,
             'client_secret': self.client_secret,
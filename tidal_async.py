@@ -0,0 +1,197 @@
+import asyncio
+import time
+
+from .tidal_api import TidalApi, TidalError, SessionType, loads_json
+from .tidal_cache import ResponseCache, SqliteStore
+from .tidal_http import RequestScheduler
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+
+class AsyncTidalApi(TidalApi):
+    """
+    asyncio variant of TidalApi with the same functions, every get_*() function returns a coroutine. All requests
+    share one pooled aiohttp.ClientSession which is limited to max_workers connections
+    """
+    def __init__(self, sessions: dict, cache: ResponseCache = None, max_workers: int = 8,
+                 scheduler: RequestScheduler = None, id_types: SqliteStore = None):
+        if aiohttp is None:
+            raise TidalError('AsyncTidalApi requires aiohttp, install it with "pip install aiohttp"')
+
+        super().__init__(sessions, cache=cache, max_workers=max_workers, scheduler=scheduler, id_types=id_types)
+
+        # the aiohttp.ClientSession has to be created inside the running event loop
+        self.s = None
+        # asyncio.Lock objects instead of threading.Lock, created on first use inside the event loop
+        self.refresh_locks = {}
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+    async def close(self):
+        if self.s is not None:
+            await self.s.close()
+            self.s = None
+
+    def _client(self):
+        if self.s is None:
+            self.s = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.max_workers))
+        return self.s
+
+    async def _refresh(self, session_type: SessionType, authorization: str):
+        lock = self.refresh_locks.setdefault(session_type.name, asyncio.Lock())
+        async with lock:
+            session = self.sessions[session_type.name]
+            # another request already refreshed the token while this one was waiting for the lock
+            if session.auth_headers()['Authorization'] != authorization:
+                return
+
+            # TidalSession.refresh() is blocking, run it in the default executor
+            await asyncio.get_running_loop().run_in_executor(None, session.refresh)
+
+    async def _send(self, session_type: SessionType, url, headers, params):
+        # aiohttp only accepts str and int query values, requests converts booleans to "True"/"False"
+        params = {k: str(v) for k, v in params.items()}
+
+        attempt = 0
+        while True:
+            await asyncio.sleep(self.scheduler.reserve(session_type.name))
+            start = time.monotonic()
+            try:
+                async with self._client().get(self.TIDAL_API_BASE + url, headers=headers, params=params) as resp:
+                    status_code, resp_headers, content = resp.status, resp.headers, await resp.read()
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                self.metrics.record_request(url, 'error', time.monotonic() - start)
+                delay = self.scheduler.retry_delay(session_type.name, attempt)
+                if delay is None:
+                    raise
+            else:
+                self.metrics.record_request(url, status_code, time.monotonic() - start, len(content))
+                delay = self.scheduler.retry_delay(session_type.name, attempt, status_code,
+                                                   resp_headers.get('Retry-After'))
+                if delay is None:
+                    return status_code, resp_headers, content
+
+            self.metrics.record_retry(url)
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def _get(self, url, params=None, session_type: SessionType = None, refresh=False):
+        session_type = session_type or self.current_session_type()
+        params = self._prepare_params(session_type, params)
+
+        headers = self.sessions[session_type.name].auth_headers()
+
+        # check the response cache first, a stale entry is revalidated with its ETag/Last-Modified
+        cache_key, cache_ttl, cache_entry = self._cache_lookup(session_type, url, params)
+        if cache_entry:
+            if cache_entry.fresh():
+                self.metrics.record_cache_hit(url)
+                return loads_json(cache_entry.content)
+            headers.update(cache_entry.validators())
+
+        status_code, resp_headers, content = await self._send(session_type, url, headers, params)
+
+        # if the request 401s or 403s, try refreshing the TV/Mobile session in case that helps
+        if not refresh and (status_code == 401 or status_code == 403):
+            self.metrics.record_token_refresh(url)
+            await self._refresh(session_type, headers['Authorization'])
+            return await self._get(url, params, session_type, True)
+
+        if status_code == 304 and cache_entry:
+            self.metrics.record_cache_hit(url)
+            self.cache.touch(cache_key, cache_ttl)
+            return loads_json(cache_entry.content)
+
+        resp_json = self._parse_response(status_code, content)
+
+        if cache_key and status_code == 200:
+            self.cache.set(cache_key, content, resp_headers.get('ETag'), resp_headers.get('Last-Modified'), cache_ttl)
+
+        return resp_json
+
+    async def iter_playlist_items(self, playlist_id, limit: int = 100):
+        async def fetch_page(offset):
+            return offset, await self._get('playlists/' + playlist_id + '/items', {
+                'offset': offset,
+                'limit': limit
+            })
+
+        # the first page is needed to know totalNumberOfItems
+        offset, result = await fetch_page(0)
+        yield offset, result
+
+        for page in asyncio.as_completed([fetch_page(offset) for offset in
+                                          range(limit, result['totalNumberOfItems'], limit)]):
+            yield await page
+
+    def _iter_pages(self, fetch_page, offsets):
+        # the thread pool pagination of TidalApi can't run coroutines, every paginated function is async here
+        raise TidalError('AsyncTidalApi only supports the async pagination functions')
+
+    async def iter_paged_list(self, data_api_path, total, limit: int = 50, session_type: SessionType = None):
+        async def fetch_page(offset):
+            return offset, await self.get_page(data_api_path, params={
+                'limit': limit,
+                'offset': offset
+            }, session_type=session_type)
+
+        # the connector limits the concurrent requests to max_workers
+        for page in asyncio.as_completed([fetch_page(offset) for offset in range(0, total, limit)]):
+            yield await page
+
+    async def iter_album_contributors(self, album_id, limit: int = 100):
+        async def fetch_page(offset):
+            return offset, await self.get_album_contributors(album_id, offset=offset, limit=limit)
+
+        # the first page is needed to know totalNumberOfItems
+        offset, result = await fetch_page(0)
+        yield offset, result
+
+        for page in asyncio.as_completed([fetch_page(offset) for offset in
+                                          range(limit, result['totalNumberOfItems'], limit)]):
+            yield await page
+
+    async def get_playlist_items(self, playlist_id):
+        result, pages = None, {}
+        async for offset, page in self.iter_playlist_items(playlist_id):
+            if result is None:
+                result = page
+            pages[offset] = page['items']
+
+        # put the items back in the playlist order
+        result['items'] = [item for offset in sorted(pages) for item in pages[offset]]
+        return result
+
+    async def get_type_from_id(self, id_):
+        # bare ids which were already resolved once don't need any request
+        id_type = self.id_types.get(str(id_)) if self.id_types is not None else None
+        if id_type:
+            return id_type
+
+        probes = [('a', self.get_album), ('r', self.get_artist), ('t', self.get_track), ('v', self.get_video)]
+        tasks = [asyncio.ensure_future(get(id_)) for _, get in probes]
+        try:
+            # all probes run at once, but the album > artist > track > video priority is kept
+            for (id_type, _), task in zip(probes, tasks):
+                try:
+                    await task
+                except TidalError:
+                    continue
+
+                if self.id_types is not None:
+                    self.id_types.set(str(id_), id_type)
+                return id_type
+        finally:
+            # cancel the probes which are no longer needed and collect their results
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+        return None
@@ -0,0 +1,199 @@
+import json
+import sqlite3
+import threading
+import time
+import zlib
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Optional
+
+
+@dataclass
+class CacheEntry:
+    content: bytes
+    etag: Optional[str]
+    last_modified: Optional[str]
+    expires: float
+
+    def fresh(self) -> bool:
+        return time.time() < self.expires
+
+    def validators(self) -> dict:
+        # conditional request headers used to revalidate a stale entry
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        return headers
+
+
+class LruCache:
+    """
+    Thread safe in-memory cache which keeps at most max_size entries, the least recently used entry is removed first
+    """
+    def __init__(self, max_size: int = 256):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.entries
+
+    def __len__(self):
+        with self.lock:
+            return len(self.entries)
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key not in self.entries:
+                return default
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+
+class ResponseCache(ABC):
+    """
+    Abstract response cache used by TidalApi._get(), needs get(), set() and touch()
+    """
+    @abstractmethod
+    def get(self, key: str) -> Optional[CacheEntry]:
+        pass
+
+    @abstractmethod
+    def set(self, key: str, content: bytes, etag: str = None, last_modified: str = None, ttl: int = 0):
+        pass
+
+    @abstractmethod
+    def touch(self, key: str, ttl: int):
+        pass
+
+
+class SqliteResponseCache(ResponseCache):
+    """
+    Persistent zlib compressed response cache stored in a SQLite database, evicts the least recently used entries
+    once max_size (in bytes) is exceeded. The total size is kept in memory and the access times of cache hits are
+    written in batches, so a cache hit doesn't write to the database
+    """
+    def __init__(self, path: str, max_size: int = 256 * 1024 * 1024, flush_interval: float = 30,
+                 flush_size: int = 256):
+        self.max_size = max_size
+        self.lock = threading.Lock()
+
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS responses ('
+                        'key TEXT PRIMARY KEY, content BLOB, etag TEXT, last_modified TEXT, '
+                        'expires REAL, last_access REAL, size INTEGER)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)')
+        self.db.commit()
+
+        # only summed up once, set() and _evict() keep it up to date
+        self.total_size = self.db.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+
+        # access times of cache hits which aren't written yet, flushed after flush_interval seconds or flush_size hits
+        self.accessed = {}
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self.flushed = time.monotonic()
+
+    def get(self, key: str) -> Optional[CacheEntry]:
+        with self.lock:
+            row = self.db.execute('SELECT content, etag, last_modified, expires FROM responses WHERE key = ?',
+                                  (key,)).fetchone()
+            if not row:
+                return None
+
+            self.accessed[key] = time.time()
+            if len(self.accessed) >= self.flush_size or time.monotonic() - self.flushed >= self.flush_interval:
+                self._flush()
+                self.db.commit()
+
+        content, etag, last_modified, expires = row
+        return CacheEntry(zlib.decompress(content), etag, last_modified, expires)
+
+    def set(self, key: str, content: bytes, etag: str = None, last_modified: str = None, ttl: int = 0):
+        compressed = zlib.compress(content)
+        now = time.time()
+
+        with self.lock:
+            row = self.db.execute('SELECT size FROM responses WHERE key = ?', (key,)).fetchone()
+            self.db.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)',
+                            (key, compressed, etag, last_modified, now + ttl, now, len(compressed)))
+            self.accessed.pop(key, None)
+            self.total_size += len(compressed) - (row[0] if row else 0)
+            self._evict()
+            self.db.commit()
+
+    def touch(self, key: str, ttl: int):
+        # the server answered 304 Not Modified, so the stored entry is fresh again
+        now = time.time()
+        with self.lock:
+            self.db.execute('UPDATE responses SET expires = ?, last_access = ? WHERE key = ?', (now + ttl, now, key))
+            self.accessed.pop(key, None)
+            self.db.commit()
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+            self.db.commit()
+
+    def _flush(self):
+        if self.accessed:
+            self.db.executemany('UPDATE responses SET last_access = ? WHERE key = ?',
+                                [(last_access, key) for key, last_access in self.accessed.items()])
+            self.accessed = {}
+        self.flushed = time.monotonic()
+
+    def _evict(self):
+        if self.total_size <= self.max_size:
+            return
+
+        # the least recently used order needs the pending access times
+        self._flush()
+
+        # free up to 90% of max_size so not every following insert has to evict again
+        rows = self.db.execute('SELECT key, size FROM responses ORDER BY last_access').fetchall()
+        for key, size in rows:
+            if self.total_size <= self.max_size * 0.9:
+                break
+            self.db.execute('DELETE FROM responses WHERE key = ?', (key,))
+            self.total_size -= size
+
+
+class SqliteStore:
+    """
+    Small persistent key value store, values are stored as JSON in the given table of a SQLite database
+    """
+    def __init__(self, path: str, table: str):
+        self.table = table
+        self.lock = threading.Lock()
+
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute(f'CREATE TABLE IF NOT EXISTS {table} (key TEXT PRIMARY KEY, value TEXT)')
+        self.db.commit()
+
+    def get(self, key: str, default=None):
+        with self.lock:
+            row = self.db.execute(f'SELECT value FROM {self.table} WHERE key = ?', (key,)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def set(self, key: str, value):
+        with self.lock:
+            self.db.execute(f'INSERT OR REPLACE INTO {self.table} VALUES (?, ?)', (key, json.dumps(value)))
+            self.db.commit()
+
+    def delete(self, key: str):
+        with self.lock:
+            self.db.execute(f'DELETE FROM {self.table} WHERE key = ?', (key,))
+            self.db.commit()
@@ -0,0 +1,304 @@
+import json
+import os
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
+
+class DownloadError(Exception):
+    def __init__(self, message):
+        super(DownloadError, self).__init__(message)
+
+
+def _backoff(attempt: int, base: float = 0.5, maximum: float = 30):
+    # full jitter exponential backoff between two download attempts
+    time.sleep(random.uniform(0, min(maximum, base * 2 ** attempt)))
+
+
+def _check_size(r, size: int):
+    # a truncated response is only detectable if it isn't content encoded
+    expected = r.headers.get('Content-Length')
+    if expected is not None and 'Content-Encoding' not in r.headers and int(expected) != size:
+        raise DownloadError(f'Incomplete download, got {size} of {expected} bytes')
+
+
+class DownloadCheckpoint:
+    """
+    Checkpoint of a partly downloaded track, keyed by track id and quality. The data is appended in order to a .part
+    file and the manifest records the size of every completed segment (or chunk), so a resumed download only fetches
+    the missing ones
+    """
+    def __init__(self, folder: str, key: str):
+        os.makedirs(folder, exist_ok=True)
+        self.part_path = os.path.join(folder, key + '.part')
+        self.manifest_path = os.path.join(folder, key + '.json')
+
+        self.sizes, self.total = [], None
+        if os.path.isfile(self.manifest_path) and os.path.isfile(self.part_path):
+            try:
+                with open(self.manifest_path, 'r', encoding='utf-8') as f:
+                    manifest = json.load(f)
+                self.sizes, self.total = manifest['sizes'], manifest.get('total')
+            except (ValueError, KeyError):
+                pass
+
+        # only keep the segments which are completely inside the .part file
+        part_size = os.path.getsize(self.part_path) if os.path.isfile(self.part_path) else 0
+        while self.sizes and sum(self.sizes) > part_size:
+            self.sizes.pop()
+
+        self.file = open(self.part_path, 'r+b' if os.path.isfile(self.part_path) else 'wb')
+        self.file.truncate(self.size)
+        self.file.seek(self.size)
+
+    @property
+    def completed(self) -> int:
+        return len(self.sizes)
+
+    @property
+    def size(self) -> int:
+        return sum(self.sizes)
+
+    def _save(self):
+        # write the manifest atomically, the data is always flushed before
+        with open(self.manifest_path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump({'sizes': self.sizes, 'total': self.total}, f)
+        os.replace(self.manifest_path + '.tmp', self.manifest_path)
+
+    def set_total(self, total: int):
+        # a different total size means the stored data belongs to another file, so start from scratch
+        if self.total is not None and total != self.total:
+            self.reset()
+        self.total = total
+        self._save()
+
+    def append(self, data: bytes):
+        self.file.write(data)
+        self.file.flush()
+        self.sizes.append(len(data))
+        self._save()
+
+    def reset(self):
+        self.sizes = []
+        self.file.seek(0)
+        self.file.truncate()
+        self._save()
+
+    def finish(self, path: str) -> str:
+        # moves the completed .part file to path and removes the manifest
+        self.file.close()
+        os.replace(self.part_path, path)
+        os.remove(self.manifest_path)
+        return path
+
+    def close(self):
+        self.file.close()
+
+
+class SegmentDownloader:
+    """
+    Downloads MPEG-DASH segments with a bounded worker pool over a kept alive session and yields them in order.
+    global_slots limits the concurrent segment downloads across all tracks
+    """
+    def __init__(self, session, concurrency: int = 4, global_slots: threading.Semaphore = None, progress=None,
+                 max_retries: int = 3):
+        self.session = session
+        self.concurrency = max(1, concurrency)
+        self.global_slots = global_slots
+        # tqdm progress bar shared by all workers, updated once per finished segment
+        self.progress = progress
+        # every segment has its own retry budget
+        self.max_retries = max_retries
+
+    def _get(self, url: str) -> bytes:
+        if self.global_slots is not None:
+            with self.global_slots:
+                r = self.session.get(url)
+        else:
+            r = self.session.get(url)
+
+        r.raise_for_status()
+        _check_size(r, len(r.content))
+        return r.content
+
+    def _fetch(self, url: str) -> bytes:
+        attempt = 0
+        while True:
+            try:
+                segment = self._get(url)
+                break
+            except (OSError, DownloadError):  # requests exceptions are OSErrors
+                if attempt >= self.max_retries:
+                    raise
+                _backoff(attempt)
+                attempt += 1
+
+        if self.progress is not None:
+            self.progress.update(1)
+        return segment
+
+    def iter_segments(self, urls):
+        # only keep twice the concurrency of segments in flight, so a slow segment can't fill up the memory
+        urls = iter(urls)
+        executor = ThreadPoolExecutor(max_workers=self.concurrency)
+        pending = deque(executor.submit(self._fetch, url) for url in islice(urls, self.concurrency * 2))
+        try:
+            while pending:
+                segment = pending.popleft().result()
+                for url in islice(urls, 1):
+                    pending.append(executor.submit(self._fetch, url))
+                yield segment
+        finally:
+            # a segment failed or the consumer stopped early, don't download the remaining segments
+            for future in pending:
+                future.cancel()
+            executor.shutdown(wait=False)
+
+
+def download_url(session, url: str, checkpoint: DownloadCheckpoint, max_retries: int = 3, chunk_size: int = 1048576):
+    # downloads a single file into the checkpoint, resumes with a Range request after a failure or restart
+    attempt = 0
+    while True:
+        # the checkpoint already holds the whole file, a Range request from its end would be unsatisfiable
+        if checkpoint.total is not None and checkpoint.size == checkpoint.total:
+            return
+
+        try:
+            headers = {'Range': f'bytes={checkpoint.size}-'} if checkpoint.size else {}
+            with session.get(url, headers=headers, stream=True) as r:
+                if r.status_code == 416 and checkpoint.size:
+                    # the stored data doesn't fit the file on the server anymore, start from scratch
+                    checkpoint.reset()
+                    continue
+                r.raise_for_status()
+
+                if r.status_code == 206:
+                    # Content-Range: bytes <start>-<end>/<total>
+                    content_range = r.headers['Content-Range'].split(' ')[-1]
+                    start, total = int(content_range.split('-')[0]), int(content_range.split('/')[-1])
+                    if checkpoint.size and (start != checkpoint.size or checkpoint.total not in (None, total)):
+                        # the file on the server changed or the range doesn't continue the stored data, the body is
+                        # discarded and the next request starts from scratch
+                        checkpoint.reset()
+                        checkpoint.set_total(total)
+                        continue
+                    if start != checkpoint.size:
+                        raise DownloadError(f'Range response starts at byte {start} instead of {checkpoint.size}')
+                else:
+                    # the server ignored the Range header, start from scratch
+                    if checkpoint.size:
+                        checkpoint.reset()
+                    total = int(r.headers['Content-Length']) if 'Content-Length' in r.headers else None
+
+                if total is not None:
+                    checkpoint.set_total(total)
+
+                for chunk in r.iter_content(chunk_size=chunk_size):
+                    if chunk:
+                        checkpoint.append(chunk)
+
+            if total is not None and checkpoint.size != total:
+                raise DownloadError(f'Incomplete download, got {checkpoint.size} of {total} bytes')
+            return
+        except (OSError, DownloadError):  # requests exceptions are OSErrors
+            if attempt >= max_retries:
+                raise
+            _backoff(attempt)
+            attempt += 1
+
+
+def _download_range(session, url: str, path: str, start: int, end: int, max_retries: int = 3,
+                    chunk_size: int = 1048576):
+    # writes the bytes start-end (inclusive) of url at the same position of the preallocated file
+    attempt, position = 0, start
+    with open(path, 'r+b') as f:
+        while position <= end:
+            try:
+                with session.get(url, headers={'Range': f'bytes={position}-{end}'}, stream=True) as r:
+                    r.raise_for_status()
+                    if r.status_code != 206:
+                        raise DownloadError(f'Range request for bytes {position}-{end} was ignored')
+
+                    f.seek(position)
+                    for chunk in r.iter_content(chunk_size=chunk_size):
+                        f.write(chunk)
+                        position += len(chunk)
+
+                if position <= end:
+                    raise DownloadError(f'Incomplete range, got bytes {start}-{position - 1} of {start}-{end}')
+            except (OSError, DownloadError):  # requests exceptions are OSErrors
+                if attempt >= max_retries:
+                    raise
+                _backoff(attempt)
+                attempt += 1
+
+
+def _probe_size(session, url: str):
+    # returns the total size from a one byte Range request, or None if the server doesn't answer it with a 206. A failed
+    # probe only means the file is downloaded with a single stream, it doesn't fail the download
+    try:
+        with session.get(url, headers={'Range': 'bytes=0-0'}, stream=True) as r:
+            r.raise_for_status()
+            if r.status_code != 206:
+                return None
+            total = r.headers.get('Content-Range', '').rpartition('/')[2]
+            return int(total) if total.isdigit() else None
+    except (OSError, ValueError):  # requests exceptions are OSErrors
+        return None
+
+
+def download_ranges(session, url: str, path: str, connections: int = 4, min_part_size: int = 4194304,
+                    max_retries: int = 3, prefix: bytes = b'', size: int = None):
+    """
+    Downloads url to path with up to connections concurrent Range requests into a preallocated file, falls back to a
+    single stream if the server doesn't support ranges or the size probe fails. prefix are the already downloaded
+    first bytes of a file with the given total size (e.g. from a Range probe), they aren't fetched again
+    """
+    # a given size came from a 206 Partial Content response
+    if size is None:
+        size = _probe_size(session, url)
+
+    if not size:
+        with open(path, 'wb') as f:
+            attempt = 0
+            while True:
+                try:
+                    f.seek(0)
+                    f.truncate()
+                    with session.get(url, stream=True) as r:
+                        r.raise_for_status()
+                        for chunk in r.iter_content(chunk_size=1048576):
+                            f.write(chunk)
+                        _check_size(r, f.tell())
+                    return
+                except (OSError, DownloadError):  # requests exceptions are OSErrors
+                    if attempt >= max_retries:
+                        raise
+                    _backoff(attempt)
+                    attempt += 1
+
+    # preallocate the file, every part writes at its own offset
+    with open(path, 'wb') as f:
+        f.write(prefix)
+        f.truncate(size)
+
+    offset = len(prefix)
+    if offset >= size:
+        return
+
+    parts = max(1, min(connections, (size - offset) // min_part_size))
+    part_size = -(-(size - offset) // parts)
+    executor = ThreadPoolExecutor(max_workers=parts)
+    futures = [executor.submit(_download_range, session, url, path, start, min(start + part_size, size) - 1,
+                               max_retries) for start in range(offset, size, part_size)]
+    try:
+        for future in futures:
+            future.result()
+    finally:
+        # one part failed for good, don't download the others
+        for future in futures:
+            future.cancel()
+        executor.shutdown(wait=False)
@@ -0,0 +1,363 @@
+import copy
+import json
+import logging
+import random
+import re
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from typing import Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+
+class TokenBucket:
+    """
+    Thread safe token bucket, rate is the number of requests per second (None or 0 for unlimited) and burst the
+    maximum number of tokens
+    """
+    def __init__(self, rate: float = None, burst: int = None):
+        self.rate = rate or 0
+        self.burst = burst or max(1, int(self.rate))
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+        # set after a 429 so every request of this bucket waits for the Retry-After
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def reserve(self) -> float:
+        # takes one token and returns how many seconds the caller has to wait before sending the request
+        with self.lock:
+            now = time.monotonic()
+            pause = max(0.0, self.paused_until - now)
+            if not self.rate:
+                return pause
+
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0.0
+            return max(delay, pause)
+
+    def pause(self, seconds: float):
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+class RequestScheduler:
+    """
+    Schedules all API requests: one token bucket per session type, honours 429 + Retry-After and retries 5xx
+    responses and connection errors with jittered exponential backoff
+    """
+    RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+    def __init__(self, rates=None, max_retries: int = 5, backoff_base: float = 0.5, backoff_max: float = 60):
+        # requests per second for every session type, or one rate for all of them. Missing session types and None
+        # aren't rate limited
+        self.rates = rates if rates is not None else {}
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+        self.throttled_seconds = 0.0
+        self.throttled_requests = 0
+        self.rate_limited = 0
+        self.retries = 0
+
+    def _bucket(self, key: str) -> TokenBucket:
+        with self.lock:
+            if key not in self.buckets:
+                rate = self.rates.get(key) if isinstance(self.rates, dict) else self.rates
+                self.buckets[key] = TokenBucket(rate)
+            return self.buckets[key]
+
+    def _throttled(self, seconds: float):
+        with self.lock:
+            self.throttled_seconds += seconds
+            self.throttled_requests += 1
+
+    def reserve(self, key: str) -> float:
+        # seconds to wait before the next request of the session type key may be sent
+        delay = self._bucket(key).reserve()
+        if delay > 0:
+            self._throttled(delay)
+        return delay
+
+    @staticmethod
+    def parse_retry_after(retry_after: Optional[str]) -> Optional[float]:
+        # Retry-After is either delta-seconds or an HTTP-date
+        if not retry_after:
+            return None
+        try:
+            return max(0.0, float(retry_after))
+        except ValueError:
+            pass
+        try:
+            return max(0.0, parsedate_to_datetime(retry_after).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+    def retry_delay(self, key: str, attempt: int, status_code: int = None, retry_after: str = None) \
+            -> Optional[float]:
+        # returns the seconds to wait before retrying, None if the request shouldn't be retried. status_code is None
+        # if the request failed with a connection error
+        if status_code is not None and status_code not in self.RETRY_STATUS_CODES:
+            return None
+        if attempt >= self.max_retries:
+            return None
+
+        # full jitter: a random delay between 0 and the exponential backoff
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+        if status_code == 429:
+            delay = self.parse_retry_after(retry_after) or delay
+            # every request of this session type has to wait, not only this one
+            self._bucket(key).pause(delay)
+            with self.lock:
+                self.rate_limited += 1
+            self._throttled(delay)
+
+        with self.lock:
+            self.retries += 1
+        return delay
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                'throttled_seconds': self.throttled_seconds,
+                'throttled_requests': self.throttled_requests,
+                'rate_limited': self.rate_limited,
+                'retries': self.retries
+            }
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls with the same key: only the first caller runs the function, all others wait for it
+    and get a copy of its result (or its exception)
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def do(self, key, fn):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = _Call()
+            else:
+                call.waiters += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return copy.deepcopy(call.result)
+
+        try:
+            call.result = fn()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+
+        # the callers are free to modify their result, so nobody gets the shared object if there were waiters
+        return copy.deepcopy(call.result) if call.waiters else call.result
+
+
+class ApiMetrics:
+    """
+    Thread safe in-process metrics per endpoint template (e.g. albums/{id}/items/credits): requests, status codes,
+    latency histogram, bytes in, retries, token refreshes and cache hits
+    """
+    LATENCY_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+    ID_PATTERN = re.compile(r'(?<=/)\d+(?=/|$)')
+    UUID_PATTERN = re.compile(r'(?<=/)[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}(?=/|$)')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.endpoints = {}
+
+    @classmethod
+    def endpoint_template(cls, path: str) -> str:
+        path = cls.UUID_PATTERN.sub('{uuid}', path)
+        return cls.ID_PATTERN.sub('{id}', path)
+
+    def _endpoint(self, path: str) -> dict:
+        # needs to be called with self.lock held
+        template = self.endpoint_template(path)
+        if template not in self.endpoints:
+            self.endpoints[template] = {
+                'requests': 0,
+                'status_codes': {},
+                'latency_buckets': [0] * (len(self.LATENCY_BUCKETS) + 1),
+                'latency_sum': 0.0,
+                'bytes_in': 0,
+                'retries': 0,
+                'token_refreshes': 0,
+                'cache_hits': 0
+            }
+        return self.endpoints[template]
+
+    def record_request(self, path: str, status_code, latency: float, bytes_in: int = 0):
+        # status_code is 'error' if the request failed without a response
+        with self.lock:
+            endpoint = self._endpoint(path)
+            endpoint['requests'] += 1
+            endpoint['status_codes'][str(status_code)] = endpoint['status_codes'].get(str(status_code), 0) + 1
+            endpoint['latency_sum'] += latency
+            endpoint['bytes_in'] += bytes_in
+
+            bucket = next((i for i, le in enumerate(self.LATENCY_BUCKETS) if latency <= le), len(self.LATENCY_BUCKETS))
+            endpoint['latency_buckets'][bucket] += 1
+
+    def _increment(self, path: str, name: str):
+        with self.lock:
+            self._endpoint(path)[name] += 1
+
+    def record_retry(self, path: str):
+        self._increment(path, 'retries')
+
+    def record_token_refresh(self, path: str):
+        self._increment(path, 'token_refreshes')
+
+    def record_cache_hit(self, path: str):
+        self._increment(path, 'cache_hits')
+
+    def as_dict(self) -> dict:
+        with self.lock:
+            return copy.deepcopy(self.endpoints)
+
+    def to_json(self) -> str:
+        return json.dumps(self.as_dict(), indent=4, sort_keys=True)
+
+    def to_prometheus(self) -> str:
+        endpoints = self.as_dict()
+        lines = []
+
+        def counter(name, help_text, key):
+            lines.append(f'# HELP tidal_{name} {help_text}')
+            lines.append(f'# TYPE tidal_{name} counter')
+            for template, endpoint in endpoints.items():
+                lines.append(f'tidal_{name}{{endpoint="{template}"}} {endpoint[key]}')
+
+        counter('requests_total', 'HTTP requests sent per endpoint', 'requests')
+
+        lines.append('# HELP tidal_responses_total HTTP responses per endpoint and status code')
+        lines.append('# TYPE tidal_responses_total counter')
+        for template, endpoint in endpoints.items():
+            for status_code, count in endpoint['status_codes'].items():
+                lines.append(f'tidal_responses_total{{endpoint="{template}",status="{status_code}"}} {count}')
+
+        lines.append('# HELP tidal_request_duration_seconds HTTP request latency per endpoint')
+        lines.append('# TYPE tidal_request_duration_seconds histogram')
+        for template, endpoint in endpoints.items():
+            cumulative = 0
+            for le, count in zip(self.LATENCY_BUCKETS + ['+Inf'], endpoint['latency_buckets']):
+                cumulative += count
+                lines.append(f'tidal_request_duration_seconds_bucket{{endpoint="{template}",le="{le}"}} {cumulative}')
+            lines.append(f'tidal_request_duration_seconds_sum{{endpoint="{template}"}} {endpoint["latency_sum"]}')
+            lines.append(f'tidal_request_duration_seconds_count{{endpoint="{template}"}} {endpoint["requests"]}')
+
+        counter('response_bytes_total', 'Response bytes received per endpoint', 'bytes_in')
+        counter('retries_total', 'Retried requests per endpoint', 'retries')
+        counter('token_refreshes_total', 'Token refreshes after a 401/403 per endpoint', 'token_refreshes')
+        counter('cache_hits_total', 'Responses served from the metadata cache per endpoint', 'cache_hits')
+
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, path: str):
+        # writes JSON if the file ends with .json, the Prometheus text format otherwise
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(self.to_json() if path.endswith('.json') else self.to_prometheus())
+
+
+class Http2Session:
+    """
+    Minimal requests.Session like wrapper around a httpx.Client with HTTP/2 enabled, drops the connection specific
+    headers which are not allowed in HTTP/2
+    """
+    CONNECTION_HEADERS = {'connection', 'keep-alive', 'host'}
+
+    def __init__(self, pool_size: int):
+        self.client = httpx.Client(http2=True, limits=httpx.Limits(max_connections=pool_size,
+                                                                   max_keepalive_connections=pool_size))
+
+    def get(self, url, headers=None, params=None, **kwargs):
+        headers = {k: v for k, v in (headers or {}).items() if k.lower() not in self.CONNECTION_HEADERS}
+        return self.client.get(url, headers=headers, params=params, **kwargs)
+
+    def close(self):
+        self.client.close()
+
+
+class ConnectionPools:
+    """
+    Shared sessions with separate, size tunable connection pools for the API (api.tidal.com), auth (auth.tidal.com)
+    and audio CDN hosts. The API pool can optionally use HTTP/2 if httpx and h2 are installed
+    """
+    def __init__(self):
+        self.api = self.auth = self.cdn = None
+        self.http2 = False
+        self.transient_errors = (requests.ConnectionError, requests.Timeout)
+        self.configure()
+
+    @staticmethod
+    def _session(pool_size: int) -> requests.Session:
+        # no urllib3 retries, the RequestScheduler and the segment downloads retry on their own
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+
+    def configure(self, api_pool_size: int = 10, auth_pool_size: int = 2, cdn_pool_size: int = 16,
+                  http2: bool = False):
+        self.close()
+
+        self.api = self._session(api_pool_size)
+        self.auth = self._session(auth_pool_size)
+        self.cdn = self._session(cdn_pool_size)
+        self.http2 = False
+        self.transient_errors = (requests.ConnectionError, requests.Timeout)
+
+        if http2:
+            try:
+                if httpx is None:
+                    raise ImportError('httpx is not installed')
+                self.api = Http2Session(api_pool_size)
+                self.http2 = True
+                self.transient_errors += (httpx.TransportError,)
+            except ImportError as e:
+                logging.warning(f'TIDAL: HTTP/2 is not available ({e}), install it with "pip install httpx[http2]"')
+
+    def close(self):
+        for session in (self.api, self.auth, self.cdn):
+            if session is not None:
+                session.close()
+
+
+# shared by TidalApi, all TidalSession objects and the downloads in interface.py
+connection_pools = ConnectionPools()
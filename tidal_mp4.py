@@ -0,0 +1,208 @@
+import struct
+
+
+class Mp4Error(Exception):
+    def __init__(self, message):
+        super(Mp4Error, self).__init__(message)
+
+
+def iter_boxes(data, start: int = 0, end: int = None):
+    # yields (box type, payload start, box end) of all complete boxes between start and end
+    end = len(data) if end is None else end
+    while start + 8 <= end:
+        size, box_type = struct.unpack_from('>I4s', data, start)
+        header = 8
+        if size == 1:
+            if start + 16 > end:
+                return
+            size, header = struct.unpack_from('>Q', data, start + 8)[0], 16
+        elif size == 0:
+            size = end - start
+        if size < header:
+            raise Mp4Error(f'Invalid {box_type!r} box size {size}')
+        if start + size > end:
+            return
+
+        yield box_type, start + header, start + size
+        start += size
+
+
+def find_box(data, path: list, start: int = 0, end: int = None):
+    # returns (payload start, box end) of the first box at path, e.g. [b'trak', b'mdia', b'mdhd']
+    for box_type, payload, box_end in iter_boxes(data, start, end):
+        if box_type == path[0]:
+            return (payload, box_end) if len(path) == 1 else find_box(data, path[1:], payload, box_end)
+    return None
+
+
+class FlacDemuxer:
+    """
+    Extracts the FLAC frames of fragmented MP4 (MPEG-DASH) segments into a native FLAC stream without ffmpeg. The
+    data can be fed in chunks of any size, the FLAC header is written from the dfLa box of the init segment and the
+    frames of every fragment as soon as its mdat box is complete. write() gets memoryviews which are only valid during
+    the call
+    """
+    def __init__(self, write):
+        self.write = write
+        self.buffer = bytearray()
+        # start of the first box in the buffer which isn't parsed yet
+        self.position = 0
+
+        self.timescale = None
+        self.sample_rate = None
+        self.default_duration = 0
+        self.default_size = 0
+        # (absolute offset in the buffer, size, duration) of every run of the last moof box
+        self.runs = []
+        self.samples = 0
+
+    def feed(self, data: bytes):
+        self.buffer += data
+
+        consumed = 0
+        for box_type, payload, box_end in iter_boxes(self.buffer, self.position):
+            if box_type == b'moov':
+                self._parse_moov(payload, box_end)
+            elif box_type == b'moof':
+                self._parse_moof(payload - 8, payload, box_end)
+            elif box_type == b'mdat':
+                self._write_samples(payload, box_end)
+
+            self.position = box_end
+            # the sample offsets are relative to the moof box, keep it until its mdat box is complete
+            if not self.runs:
+                consumed = box_end
+
+        if consumed:
+            del self.buffer[:consumed]
+            self.position -= consumed
+            # a pending moof box moved to the front of the buffer
+            self.runs = [(offset if offset is None else offset - consumed, size, duration)
+                         for offset, size, duration in self.runs]
+
+    def close(self):
+        if self.buffer or self.runs:
+            raise Mp4Error('Incomplete fragment at the end of the stream')
+        if self.sample_rate is None:
+            raise Mp4Error('No FLAC init segment found')
+
+    @property
+    def total_samples(self) -> int:
+        # sample durations are in the media timescale, FLAC counts samples at the sample rate
+        if not self.timescale or self.timescale == self.sample_rate:
+            return self.samples
+        return self.samples * self.sample_rate // self.timescale
+
+    def patch_streaminfo(self, file):
+        # fragmented FLAC usually has 0 total samples in STREAMINFO, fill it in so players can show the duration
+        file.seek(18)
+        value, = struct.unpack('>Q', file.read(8))
+        if value & 0xFFFFFFFFF == 0:
+            file.seek(18)
+            file.write(struct.pack('>Q', value | min(self.total_samples, 0xFFFFFFFFF)))
+
+    def _parse_moov(self, start: int, end: int):
+        buffer = self.buffer
+
+        mdhd = find_box(buffer, [b'trak', b'mdia', b'mdhd'], start, end)
+        if mdhd:
+            version = buffer[mdhd[0]]
+            self.timescale = struct.unpack_from('>I', buffer, mdhd[0] + (20 if version == 1 else 12))[0]
+
+        trex = find_box(buffer, [b'mvex', b'trex'], start, end)
+        if trex:
+            self.default_duration, self.default_size = struct.unpack_from('>II', buffer, trex[0] + 12)
+
+        stsd = find_box(buffer, [b'trak', b'mdia', b'minf', b'stbl', b'stsd'], start, end)
+        # stsd is a full box with an entry count, the fLaC audio sample entry has 28 bytes before its child boxes
+        entry = find_box(buffer, [b'fLaC'], stsd[0] + 8, stsd[1]) if stsd else None
+        dfla = find_box(buffer, [b'dfLa'], entry[0] + 28, entry[1]) if entry else None
+        if not dfla:
+            raise Mp4Error('No FLAC sample description (dfLa) found')
+
+        # dfLa contains the FLAC metadata blocks after its version and flags, STREAMINFO first
+        blocks = bytearray(buffer[dfla[0] + 4:dfla[1]])
+        if len(blocks) < 38 or blocks[0] & 0x7F != 0:
+            raise Mp4Error('Invalid FLAC STREAMINFO')
+        self.sample_rate = int.from_bytes(blocks[14:17], 'big') >> 4
+
+        # make sure the last block has the last-metadata-block flag set
+        position = 0
+        while True:
+            length = int.from_bytes(blocks[position + 1:position + 4], 'big')
+            if position + 4 + length >= len(blocks):
+                blocks[position] |= 0x80
+                break
+            blocks[position] &= 0x7F
+            position += 4 + length
+
+        self.write(b'fLaC' + bytes(blocks))
+
+    def _parse_moof(self, moof_start: int, start: int, end: int):
+        buffer = self.buffer
+
+        for box_type, payload, box_end in iter_boxes(buffer, start, end):
+            if box_type != b'traf':
+                continue
+
+            base_offset, duration, size = moof_start, self.default_duration, self.default_size
+            for child_type, child, _ in iter_boxes(buffer, payload, box_end):
+                if child_type == b'tfhd':
+                    flags = int.from_bytes(buffer[child + 1:child + 4], 'big')
+                    position = child + 8
+                    if flags & 0x01:
+                        # base offsets relative to the start of the file only work if the segments are fed from there
+                        raise Mp4Error('Absolute base data offsets are not supported')
+                    if flags & 0x02:
+                        position += 4
+                    if flags & 0x08:
+                        duration = struct.unpack_from('>I', buffer, position)[0]
+                        position += 4
+                    if flags & 0x10:
+                        size = struct.unpack_from('>I', buffer, position)[0]
+
+                elif child_type == b'trun':
+                    self.runs.append(self._parse_trun(buffer, child, base_offset, duration, size))
+
+    def _parse_trun(self, buffer, start: int, base_offset: int, default_duration: int, default_size: int):
+        flags = int.from_bytes(buffer[start + 1:start + 4], 'big')
+        count, = struct.unpack_from('>I', buffer, start + 4)
+        position = start + 8
+
+        # without a data offset the samples follow the previous run, or start at the mdat payload
+        offset = None
+        if flags & 0x01:
+            offset = base_offset + struct.unpack_from('>i', buffer, position)[0]
+            position += 4
+        if flags & 0x04:
+            position += 4
+
+        has_duration, has_size = flags & 0x100, flags & 0x200
+        if not has_duration and not has_size:
+            return offset, count * default_size, count * default_duration
+
+        # every sample has up to four 32 bit fields, only duration and size are needed
+        fields = sum(1 for flag in (0x100, 0x200, 0x400, 0x800) if flags & flag)
+        values = struct.unpack_from(f'>{count * fields}I', buffer, position)
+        durations = values[0::fields] if has_duration else None
+        sizes = values[(1 if has_duration else 0)::fields] if has_size else None
+
+        return (offset, sum(sizes) if sizes else count * default_size,
+                sum(durations) if durations else count * default_duration)
+
+    def _write_samples(self, start: int, end: int):
+        view = memoryview(self.buffer)
+        try:
+            position = start
+            for offset, size, duration in self.runs:
+                position = position if offset is None else offset
+                if position < start or position + size > end:
+                    raise Mp4Error('Sample data outside of the mdat box')
+
+                # the samples of a run are contiguous, so the FLAC frames are written with a single slice
+                self.write(view[position:position + size])
+                position += size
+                self.samples += duration
+        finally:
+            view.release()
+        self.runs = []
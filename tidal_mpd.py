@@ -0,0 +1,135 @@
+import re
+from array import array
+
+
+class MpdError(Exception):
+    def __init__(self, message):
+        super(MpdError, self).__init__(message)
+
+
+class AudioTrack:
+    """
+    MPEG-DASH audio representation, the segment urls are generated from the SegmentTemplate when they are needed. Only
+    $Time$ templates store the start time of every segment, in a compact array
+    """
+    __slots__ = ('codec', 'sample_rate', 'bitrate', 'initialization', 'media', 'start_number', 'segment_count',
+                 'timeline')
+
+    def __init__(self, codec, sample_rate: int, bitrate: int, initialization: str, media: str,
+                 start_number: int = 1, segment_count: int = 0, timeline: array = None):
+        self.codec = codec
+        self.sample_rate = sample_rate
+        self.bitrate = bitrate
+        self.initialization = initialization
+        self.media = media
+        self.start_number = start_number
+        self.segment_count = segment_count
+        self.timeline = timeline
+
+    def __len__(self):
+        # number of urls including the init segment
+        return self.segment_count + 1
+
+    def iter_urls(self, start: int = 0):
+        # yields the init segment url followed by all media segment urls, starting at the start-th url
+        if start == 0:
+            yield self.initialization
+
+        media = self.media
+        for i in range(max(start - 1, 0), self.segment_count):
+            url = media.replace('$Number$', str(self.start_number + i))
+            if self.timeline is not None:
+                url = url.replace('$Time$', str(self.timeline[i]))
+            yield url
+
+
+def parse_iso_duration(duration: str) -> float:
+    # seconds of an ISO 8601 duration like "PT3M25.512S" as used by MPEG-DASH
+    match = re.fullmatch(r'P(?:(\d+)D)?(?:T(?:(\d+)H)?(?:(\d+)M)?(?:([\d.]+)S)?)?', duration or '')
+    if not match:
+        raise MpdError(f'Invalid duration {duration}')
+    days, hours, minutes, seconds = (float(value or 0) for value in match.groups())
+    return ((days * 24 + hours) * 60 + minutes) * 60 + seconds
+
+
+def parse_mpd(xml: bytes, codec_enum=None) -> list:
+    # codec_enum maps the codec names to OrpheusDL's CodecEnum, the names are kept without it
+    from xml.etree import ElementTree
+
+    root = ElementTree.fromstring(xml)
+    # keep the default namespace of the MPD instead of removing it from the string
+    namespace = root.tag[:root.tag.index('}') + 1] if root.tag.startswith('{') else ''
+    mpd_duration = root.get('mediaPresentationDuration')
+
+    # List of AudioTracks
+    tracks = []
+
+    for period in root.findall(namespace + 'Period'):
+        for adaptation_set in period.findall(namespace + 'AdaptationSet'):
+            for rep in adaptation_set.findall(namespace + 'Representation'):
+                # Check if representation is audio
+                content_type = adaptation_set.get('contentType')
+                if content_type != 'audio':
+                    raise MpdError('Only supports audio MPDs!')
+
+                # Codec checks
+                codec = rep.get('codecs').upper()
+                if codec.startswith('MP4A'):
+                    codec = 'AAC'
+
+                # Segment template
+                seg_template = rep.find(namespace + 'SegmentTemplate')
+                if seg_template is None:
+                    seg_template = adaptation_set.find(namespace + 'SegmentTemplate')
+                start_number = int(seg_template.get('startNumber') or 1)
+
+                # identifiers which are the same for every segment
+                identifiers = {'$RepresentationID$': rep.get('id') or '', '$Bandwidth$': rep.get('bandwidth') or ''}
+                initialization, media = seg_template.get('initialization'), seg_template.get('media')
+                for identifier, value in identifiers.items():
+                    initialization = initialization.replace(identifier, value)
+                    media = media.replace(identifier, value)
+
+                # explicit addressing in the DASH-IF timing model guidelines, also see example 9
+                # https://dashif-documents.azurewebsites.net/Guidelines-TimingModel/master/Guidelines-TimingModel.html
+                seg_timeline = seg_template.find(namespace + 'SegmentTimeline')
+                segment_count, timeline = 0, None
+                if seg_timeline is not None:
+                    # the start times are only needed for $Time$ templates
+                    timeline = array('Q') if '$Time$' in media else None
+                    cur_time = 0
+
+                    for s in seg_timeline.findall(namespace + 'S'):
+                        # Media segments start time
+                        if s.get('t'):
+                            cur_time = int(s.get('t'))
+
+                        # Segment reference
+                        repeat, duration = int(s.get('r') or 0) + 1, int(s.get('d'))
+                        if timeline is not None:
+                            timeline.extend(range(cur_time, cur_time + repeat * duration, duration))
+                        segment_count += repeat
+                        # Add duration to current time
+                        cur_time += repeat * duration
+
+                elif seg_template.get('duration'):
+                    # simple addressing in the DASH-IF timing model guidelines linked above
+                    duration = period.get('duration') or mpd_duration
+                    if not duration:
+                        raise MpdError('SegmentTemplate@duration without a Period or presentation duration')
+                    period_duration = parse_iso_duration(duration)
+                    timescale = int(seg_template.get('timescale') or 1)
+                    segment_count = -int(-period_duration * timescale // int(seg_template.get('duration')))
+
+                tracks.append(AudioTrack(
+                    codec=codec_enum[codec] if codec_enum else codec,
+                    sample_rate=int(rep.get('audioSamplingRate') or 0),
+                    bitrate=int(rep.get('bandwidth') or 0),
+                    initialization=initialization,
+                    media=media,
+                    start_number=start_number,
+                    segment_count=segment_count,
+                    timeline=timeline
+                ))
+
+    return tracks
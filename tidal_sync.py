@@ -0,0 +1,170 @@
+import threading
+from bisect import bisect_left
+from dataclasses import dataclass
+from enum import Enum, auto
+
+
+@dataclass
+class PlaylistDiff:
+    added: list
+    removed: list
+    # tracks which are in both snapshots but changed their position
+    moved: list
+    # playlist item data of the added tracks
+    data: dict
+
+
+def diff_playlist(old_tracks: list, items: list, pending: list = None) -> PlaylistDiff:
+    # compares the track ids of the stored snapshot with the current playlist items, pending tracks of the snapshot
+    # which weren't handled yet are added again as long as they are still in the playlist
+    new_tracks = [item.get('id') for item in items]
+    old_set, new_set, pending_set = set(old_tracks), set(new_tracks), set(pending or [])
+
+    added = [track for track in dict.fromkeys(new_tracks) if track not in old_set or track in pending_set]
+    removed = [track for track in dict.fromkeys(old_tracks) if track not in new_set]
+
+    added_set = set(added)
+    return PlaylistDiff(
+        added=added,
+        removed=removed,
+        moved=moved_tracks(old_tracks, new_tracks),
+        data={item.get('id'): item for item in items if item.get('id') in added_set}
+    )
+
+
+def moved_tracks(old_tracks: list, new_tracks: list) -> list:
+    # the tracks in both lists which aren't part of the longest sequence that kept its relative order
+    old_positions = {}
+    for position, track in enumerate(old_tracks):
+        old_positions.setdefault(track, position)
+
+    common = [track for track in dict.fromkeys(new_tracks) if track in old_positions]
+
+    # longest increasing subsequence of the old positions, O(n log n)
+    tails, tail_indices, previous = [], [], [-1] * len(common)
+    for i, track in enumerate(common):
+        position = old_positions[track]
+        j = bisect_left(tails, position)
+        if j:
+            previous[i] = tail_indices[j - 1]
+        if j == len(tails):
+            tails.append(position)
+            tail_indices.append(i)
+        else:
+            tails[j], tail_indices[j] = position, i
+
+    kept, i = set(), tail_indices[-1] if tail_indices else -1
+    while i != -1:
+        kept.add(i)
+        i = previous[i]
+
+    return [track for i, track in enumerate(common) if i not in kept]
+
+
+def album_watermark(album: dict) -> list:
+    # artist albums are ordered by release date, the id orders albums released on the same day
+    return [album.get('releaseDate') or '', int(album.get('id'))]
+
+
+def iter_new_albums(fetch_page, known: set, watermark: list, limit: int = 50):
+    # yields the albums which aren't known yet, stops at the first known album which isn't newer than the watermark
+    offset = 0
+    while True:
+        page = fetch_page(offset, limit)
+        for album in page.get('items'):
+            if str(album.get('id')) not in known:
+                yield album
+            elif watermark and album_watermark(album) <= watermark:
+                return
+
+        offset += limit
+        if offset >= page.get('totalNumberOfItems', 0):
+            return
+
+
+class TrackState(Enum):
+    # returned by get_track_info or by get_track_download, OrpheusDL can still fail to download or tag it
+    STARTED = auto()
+    DOWNLOADING = auto()
+    FAILED = auto()
+    # OrpheusDL moved on to the next item
+    HANDLED = auto()
+
+
+class SyncTracker:
+    """
+    Acknowledges the albums of incremental artist syncs and the tracks of incremental playlist syncs once they were
+    handled in this run. Until then they stay pending in the stores and are returned again by the next run, so an
+    interrupted run or a failed download doesn't skip them. A started track is only handled once OrpheusDL moves on
+    to the next item, see advance(), and an album is handled once all of its tracks are
+    """
+    def __init__(self, artist_store=None, playlist_store=None):
+        self.artist_store = artist_store
+        self.playlist_store = playlist_store
+        self.lock = threading.Lock()
+
+        # TrackState of every track id of this run
+        self.track_states = {}
+        # started track ids which become handled with the next advance()
+        self.started_tracks = set()
+        # track ids of every album id returned by get_album_info
+        self.album_tracks = {}
+        # pending album ids of every artist id and pending track ids of every playlist id
+        self.pending_artists = {}
+        self.pending_playlists = {}
+
+    def set_track_state(self, track_id, state: TrackState):
+        with self.lock:
+            track_id = str(track_id)
+            self.track_states[track_id] = state
+            if state is TrackState.STARTED:
+                self.started_tracks.add(track_id)
+            else:
+                self.started_tracks.discard(track_id)
+
+    def advance(self):
+        # OrpheusDL only starts the next item once the previous track was downloaded and tagged, so the started tracks
+        # are handled now. Never called at exit, an interrupted track stays pending
+        with self.lock:
+            for track_id in self.started_tracks:
+                self.track_states[track_id] = TrackState.HANDLED
+            self.started_tracks.clear()
+
+    def set_album_tracks(self, album_id, track_ids: list):
+        with self.lock:
+            self.album_tracks[str(album_id)] = [str(track_id) for track_id in track_ids]
+
+    def watch_artist(self, artist_id, album_ids):
+        with self.lock:
+            self.pending_artists[str(artist_id)] = set(album_ids)
+
+    def watch_playlist(self, playlist_id, track_ids):
+        with self.lock:
+            self.pending_playlists[str(playlist_id)] = set(track_ids)
+
+    def _track_handled(self, track_id) -> bool:
+        return self.track_states.get(str(track_id)) is TrackState.HANDLED
+
+    def _album_handled(self, album_id) -> bool:
+        tracks = self.album_tracks.get(str(album_id))
+        return tracks is not None and all(self._track_handled(track_id) for track_id in tracks)
+
+    def flush(self):
+        # removes the handled albums and tracks from the pending lists of the stores
+        with self.lock:
+            for store, pending, handled in ((self.artist_store, self.pending_artists, self._album_handled),
+                                            (self.playlist_store, self.pending_playlists, self._track_handled)):
+                for key, ids in pending.items():
+                    done = {item for item in ids if handled(item)}
+                    if not done:
+                        continue
+
+                    ids -= done
+                    stored = store.get(key)
+                    if stored is None:
+                        continue
+                    stored['pending'] = [item for item in stored.get('pending', []) if item not in done]
+                    # artist syncs move the handled albums to the acknowledged ones
+                    if 'albums' in stored:
+                        stored['albums'] = sorted(set(stored['albums']) | done)
+                    store.set(key, stored)